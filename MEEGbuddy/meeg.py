@@ -11,14 +11,17 @@ from mne import (compute_covariance, Epochs, EpochsArray, find_events,
                  make_forward_solution, read_epochs, read_source_spaces,
                  BaseEpochs, read_evokeds, EvokedArray, read_labels_from_annot,
                  Label)
-from mne.utils import set_config
-from mne.time_frequency import (tfr_morlet,tfr_array_morlet,
-                                tfr_array_multitaper,AverageTFR,morlet)
+from mne.utils import set_config, estimate_rank
+from mne.time_frequency import (tfr_morlet,tfr_array_multitaper,
+                                AverageTFR,morlet)
 from mne.minimum_norm import (make_inverse_operator,apply_inverse_epochs,
                               apply_inverse,read_inverse_operator,
                               write_inverse_operator,source_induced_power,
                               source_band_induced_power)
 import glob,re
+import hashlib
+from importlib.util import find_spec
+import mmap as mmap_module
 import numpy as np
 import os
 from .psd_multitaper_plot_tools import ButtonClickProcessor
@@ -30,9 +33,13 @@ try:
     import matplotlib.patches as patches
     import matplotlib.ticker as ticker
     from matplotlib.colors import SymLogNorm,LogNorm
+    from matplotlib.collections import LineCollection
 except:
     print('Unable to import plot tools.')
-from functools import partial
+from functools import partial, lru_cache
+from mne.filter import create_filter, _overlap_add_filter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from scipy import linalg
 from mne.connectivity import spectral_connectivity
 from mne.stats import permutation_cluster_test
@@ -40,11 +47,13 @@ from tqdm import tqdm
 from joblib import Parallel,delayed
 from . import pci
 from .gif_combine import combine_gifs
-import nitime.algorithms as tsa
+from nitime.algorithms.spectral import (dpss_windows,tapered_spectra,
+                                        mtm_cross_spectrum)
+from nitime.utils import adaptive_weights
 from scipy import interpolate
-from scipy.stats import linregress
 from scipy.signal import detrend
 from scipy.io import savemat
+from numpy.lib.format import open_memmap
 from surfer import Brain
 try:
     import naturalneighbor
@@ -60,6 +69,20 @@ try:
     from mayavi import mlab
 except:
     print('Unable to import mayavi')
+try:
+    import cupy as cp
+except:
+    cp = None
+try:
+    import h5py
+except:
+    h5py = None
+try:
+    from numba import njit, prange
+except:
+    njit = None
+    prange = range
+from scipy.fftpack import next_fast_len
 
 class MEEGbuddy:
     '''
@@ -70,6 +93,11 @@ class MEEGbuddy:
     epochs are made, and autoreject is applied.
     All data is saved automatically in BIDS-inspired format.
     '''
+    # set to True to zlib compress saved .npz files (slower, rarely smaller)
+    _compress = False
+    # number of loaded epochs kept in memory, set to 0 if memory is tight
+    _epochs_cache_size = 2
+
     def __init__(self, subject, fdata, behavior, baseline, stimuli, eeg=False,
                  meg=False, response=None, task=None, no_response=None,
                  exclude_response=None, tbuffer=1, subjects_dir=None,
@@ -118,10 +146,17 @@ class MEEGbuddy:
 
         self.process_dirs = {}
         for process in processes:
-            self.process_dirs[process] = (subjects_dir + '/' + process +
-                                          '/' + self.subject + '/')
-            if not os.path.exists(self.process_dirs[process]):
-                os.makedirs(self.process_dirs[process])
+            # trailing separator since file names are appended directly
+            self.process_dirs[process] = os.path.join(subjects_dir,process,
+                                                      self.subject,'')
+            os.makedirs(self.process_dirs[process],exist_ok=True)
+        self._fname_cache = {}
+        self._dir_cache = {}
+        self._ar_cache = {}
+        self._ar_log_cache = {}
+        self._behavior_np = {}
+        self._prepared_cache = OrderedDict()
+        self._epochs_cache = OrderedDict()
 
         self.behavior = behavior
         if self.behavior:
@@ -155,6 +190,9 @@ class MEEGbuddy:
             print('Baseline must contain a channel, start time and stop time. ' +
                   'Okay to continue, use normalized=False when making epochs')
         self.events['Baseline'] = baseline
+        self._events_all = tuple(self.events.keys())
+        self._events_no_baseline = tuple([event for event in self.events
+                                          if event != 'Baseline'])
 
         self.tbuffer = tbuffer
 
@@ -165,16 +203,35 @@ class MEEGbuddy:
 
         np.random.seed(seed)
 
-    def preprocess(self,event=None):
+    def preprocess(self,event=None,n_jobs=-1,
+                   thresh_method='bayesian_optimization'):
         # preprocessing
         self.autoMarkBads()
         self.findICA()
         for event in self.getEvents():
             self.makeEpochs(event)
-            self.markAutoReject(event)
+            self.markAutoReject(event,n_jobs=n_jobs,thresh_method=thresh_method)
 
     def _fname(self,process_dir,keyword,ftype,*tags):
         # must give process dir, any tags
+        key = (process_dir,keyword,ftype) + tags
+        if key not in self._fname_cache:
+            self._fname_cache[key] = self._make_fname(process_dir,keyword,
+                                                      ftype,*tags)
+        return self._fname_cache[key]
+
+    def _dir_listing(self,process_dir):
+        # one directory read instead of a stat per file, cleared on save
+        if process_dir not in self._dir_cache:
+            self._dir_cache[process_dir] = \
+                {entry.name for entry in
+                 os.scandir(self.process_dirs[process_dir])}
+        return self._dir_cache[process_dir]
+
+    def _isfile(self,process_dir,fname):
+        return os.path.basename(fname) in self._dir_listing(process_dir)
+
+    def _make_fname(self,process_dir,keyword,ftype,*tags):
         fname = self.process_dirs[process_dir] + self.subject
         if self.task:
             fname += '_' + self.task
@@ -190,26 +247,50 @@ class MEEGbuddy:
             fname += ftype
         return fname
 
+    def _savez(self,fname,**kwargs):
+        if self._compress:
+            np.savez_compressed(fname,**kwargs)
+        else:
+            np.savez(fname,**kwargs)
+
     def _save_behavior(self,behavior=None):
         if behavior is None:
             behavior = self.behavior
         print('Saving behavior')
-        np.savez_compressed(self._fname('behavior','behavior','.npz'),
-                            behavior=behavior)
+        fname = self._fname('behavior','behavior','.npz')
+        # store each variable as its own array when they are all plain
+        # numbers or strings so there is no pickling, otherwise as the dict
+        arrays = {}
+        if isinstance(behavior,dict):
+            for param in behavior:
+                arr = np.asarray(behavior[param])
+                if (arr.dtype.kind in 'biuf' or (arr.dtype.kind == 'U' and
+                    all([isinstance(v,str) for v in behavior[param]]))):
+                    arrays[param] = arr
+        if isinstance(behavior,dict) and len(arrays) == len(behavior):
+            np.savez(fname,**arrays)
+        else:
+            np.savez(fname,behavior=behavior)
 
     def _load_behavior(self):
         fname = self._fname('behavior','behavior','.npz')
         if os.path.isfile(fname):
             print('Loading saved behavior')
-            self.behavior = np.load(fname)['behavior'].item()
+            f = np.load(fname)
+            if f.files == ['behavior'] and f['behavior'].ndim == 0:
+                self.behavior = f['behavior'].item()
+            else:
+                self.behavior = {param:f[param].tolist() for param in f.files}
 
     def _save_raw_preprocessed(self,raw,ica=False,keyword=None):
-        print('Saving raw ' + 'preprocessed'*(not ica and keyword is None) +
-              'ica'*ica + '%s' %(keyword)*(keyword is not None))
+        self._dir_cache.pop('raw_preprocessed',None)
+        print('Saving raw ' + _tag('preprocessed',not ica and keyword is None) +
+              _tag('ica',ica) + (keyword if keyword is not None else ''))
         raw.save(self._fname('raw_preprocessed','raw','.fif','ica'*ica,keyword),
                  verbose=False,overwrite=True)
 
-    def _load_raw(self,preprocessed=False,ica=False,keyword=None):
+    def _load_raw(self,preprocessed=False,ica=False,keyword=None,preload=True):
+        # note: preload can be a file name to memory map the data to
         if keyword or ica:
             preprocessed = False
         if keyword:
@@ -218,27 +299,35 @@ class MEEGbuddy:
             if os.path.isfile(self._fname('raw_preprocessed','raw','.fif',
                                           'ica'*ica,keyword)):
                 raw = Raw(self._fname('raw_preprocessed','raw','.fif','ica'*ica,
-                                      keyword),verbose=False,preload=True)
-                print('Preprocessed'*preprocessed + 'ICA'*ica +
-                      '%s' %(keyword)*(keyword is not None)+' raw data loaded.')
+                                      keyword),verbose=False,preload=preload)
+                print(_tag('Preprocessed',preprocessed) + _tag('ICA',ica) +
+                      (keyword if keyword is not None else '') +
+                      ' raw data loaded.')
             else:
-                raise ValueError('No ' + 'preproccessed '*preprocessed +
-                                 'ICA '*ica + 'raw data file found' +
-                                 ' for %s' %(keyword)*(keyword is not None))
+                raise ValueError('No ' + _tag('preproccessed ',preprocessed) +
+                                 _tag('ICA ',ica) + 'raw data file found' +
+                                 (' for %s' %(keyword)
+                                  if keyword is not None else ''))
         else:
-            f = self.fdata[0]
-            print(f)
-            raw = Raw(f, preload=True, verbose=False)
-            raw.info['bads'] = []
-            for f in self.fdata[1:]:
+            raws = []
+            for f in self.fdata:
                 print(f)
-                r = Raw(f, preload=True, verbose=False)
+                r = Raw(f, preload=False, verbose=False)
                 r.info['bads'] = []
-                raw.append(r)
+                # pick before loading so only these channels are read and the
+                # data isn't copied afterward (which would also undo a memmap)
+                r = r.pick_types(meg=self.meg,eeg=self.eeg,stim=True,
+                                 eog=True,ecg=True,emg=True)
+                raws.append(r)
+            # appending all at once allocates the combined data once and
+            # reads each file straight into it instead of growing it per file
+            raw = raws[0]
+            if len(raws) > 1:
+                raw.append(raws[1:],preload=preload)
+            else:
+                raw._preload_data(preload)
             if self.eeg:
                 raw = raw.set_eeg_reference(ref_channels=[],projection=False)
-            raw = raw.pick_types(meg=self.meg,eeg=self.eeg,stim=True,
-                                 eog=True,ecg=True,emg=True)
         return raw
 
     def remove(self,event=None,preprocessed=False,ica=False,ar=False,
@@ -248,6 +337,12 @@ class MEEGbuddy:
         fname = self._fname(dir_name,suffix,'.fif',event,keyword)
         if os.path.isfile(fname):
             os.remove(fname)
+            self._dir_cache.pop(dir_name,None)
+            for key in [key for key in self._epochs_cache if key[0] == event]:
+                del self._epochs_cache[key]
+            for key in [key for key in self._prepared_cache
+                        if key[0] == event]:
+                del self._prepared_cache[key]
 
     def _save_ICA(self,ica,keyword=None):
         print('Saving ICA %s' %(keyword if keyword is not None else ''))
@@ -277,26 +372,35 @@ class MEEGbuddy:
     def _combine_insts(self,insts):
         if len(insts) < 1:
             raise ValueError('Nothing to combine')
-        inst_data = insts[0]._data
-        inst_info = insts[0].info
-        for inst in insts[1:]:
-            inst_data = np.concatenate([inst_data,inst._data],axis=-2)
-            inst_info['ch_names'] += inst.info['ch_names']
-            inst_info['chs'] += inst.info['chs']
-            inst_info['nchan'] += inst.info['nchan']
-
-        if isinstance(inst,BaseRaw):
+        # concatenate once rather than growing the array for every inst
+        inst_data = np.concatenate([inst._data for inst in insts],axis=-2)
+        # build the channel info once instead of extending it per inst
+        inst_info = insts[0].info.copy()
+        inst_info['chs'] = [ch for inst in insts for ch in inst.info['chs']]
+        inst_info['ch_names'] = [ch for inst in insts
+                                 for ch in inst.info['ch_names']]
+        inst_info['nchan'] = len(inst_info['ch_names'])
+
+        if isinstance(insts[0],BaseRaw):
             return RawArray(inst_data,inst_info)
         else:
-            return EpochsArray(inst_data,inst_info,events=inst[0].events,tmin=inst[0].tmin)
+            return EpochsArray(inst_data,inst_info,events=insts[0].events,
+                               tmin=insts[0].tmin)
 
     def findICA(self,eogs=None,ecgs=None,event=None,preprocessed=False,ar=False,
                 keyword_in=None,keyword_out=None,n_components=None,
                 l_freq=None,h_freq=40,detrend=1,component_optimization_n=3,
-                vis_tmin=None,vis_tmax=None,seed=11,overwrite=False):
+                vis_tmin=None,vis_tmax=None,seed=11,n_jobs=None,
+                decim=None,reject=None,start=None,stop=None,method='picard',
+                use_gpu=False,overwrite=False):
         # keyword_out functionality was added so that ICA can be computed on
         # one raw data and applied to another
         # note: filter only filters evoked
+        # note: n_jobs defaults to fitting each data type in parallel
+        # note: ICA doesn't need every sample to converge, fit time is about
+        # linear in samples so decim=int(round(sfreq/100)) is a good speedup
+        # note: picard converges much faster than fastica for the same result
+        # note: use_gpu applies the ica with cupy if it is installed
         if os.path.isfile(self._fname('ica','ica','.fif',keyword_out)) and not overwrite:
             raise ValueError('ICA already calculated, use \'overwrite=True\' ' +
                              'to recalculate.')
@@ -310,14 +414,20 @@ class MEEGbuddy:
         if n_components is None:
             n_components = inst.estimate_rank()
 
+        if method == 'picard' and find_spec('picard') is None:
+            print('Unable to import picard, using fastica')
+            method = 'fastica'
         data_types = ['grad','mag']*self.meg + ['eeg']*self.eeg
+        # the fits are independent so do them in parallel, plotting isn't
+        # process safe so it is done afterward
+        icas = Parallel(n_jobs=len(data_types) if n_jobs is None else n_jobs)(
+            delayed(_fit_ica)(inst,dt,n_components,seed,method=method,
+                              decim=decim,reject=reject,start=start,stop=stop)
+            for dt in data_types)
         ica_insts = []
-        for dt in data_types:
-            ica = ICA(method='fastica',n_components=n_components,
-                      random_state=seed)
+        for dt,ica in zip(data_types,icas):
             inst2 = inst.copy().pick_types(meg=False if dt == 'eeg' else dt,
                                            eeg=(dt == 'eeg'))
-            ica.fit(inst2)
             fig = ica.plot_components(picks=np.arange(ica.n_components),
                                       show=False)
             kw = dt if keyword_out is None else dt + '_' + keyword_out
@@ -334,7 +444,7 @@ class MEEGbuddy:
                 ica = self._optimize_components(raw,ica,all_scores,
                                                 component_optimization_n,
                                                 keyword_in,kw)'''
-            inst2 = ica.apply(inst2, exclude=ica.exclude)
+            inst2 = _apply_ica_fast(ica,inst2,copy=False,use_gpu=use_gpu)
             self._save_ICA(ica,keyword=kw)
             ica_insts.append(inst2)
         ica_insts.append(inst.copy().pick_types(meg=False,eeg=False,eog=True,ecg=True,stim=True))
@@ -357,47 +467,61 @@ class MEEGbuddy:
                 component = current_scores.index(max(current_scores))
                 components.append(component)
                 current_scores.pop(component)
-        # get ways to combine the components
-        def int2bin(n,i):
-            b = []
-            for j in range(n-1,-1,-1):
-                if i/(2**j):
-                    i -= 2**j
-                    b.append(1)
-                else:
-                    b.append(0)
-            return list(reversed(b))
-        combinations = [int2bin(len(components),i) for i in range(2**len(components))]
-        min_score = None
         evokeds = {}
         for ch in all_scores:
             if kw:
                 evokeds[ch] = self._load_evoked('ica_%s_%s' %(ch,kw),keyword=keyword)
             else:
                 evokeds[ch] = self._load_evoked('ica_%s' %(ch),keyword=keyword)
-                print('Testing ICA component combinations for minimum correlation to artifact epochs')
-        for combo in tqdm(combinations):
+        print('Testing ICA component combinations for minimum correlation to artifact epochs')
+        # the sources only need to be computed once, each candidate differs
+        # from the current selection by one component so it is just a rank-1
+        # update of the cleaned data
+        mixing,unmixing,offset = _ica_mixing(ica)
+        cleaned,sources,ch_mixing = {},{},{}
+        for ch in all_scores:
+            evoked = evokeds[ch]
+            sfreq = int(evoked.info['sfreq'])
+            picks = [evoked.ch_names.index(name) for name in ica.ch_names]
+            cleaned[ch] = evoked.data[:,sfreq//10:-sfreq//10]
+            sources[ch] = unmixing.dot(cleaned[ch][picks]) - offset[:,np.newaxis]
+            ch_mixing[ch] = np.zeros((len(evoked.ch_names),mixing.shape[1]))
+            ch_mixing[ch][picks] = mixing
+        def remove_component(evoked_data,ch,component):
+            return evoked_data - np.outer(ch_mixing[ch][:,component],
+                                          sources[ch][component])
+        def get_score(component=None):
             score = 0
-            ica.exclude = [component for i,component in enumerate(components) if combo[i]]
             for ch in all_scores:
-                evoked = ica.apply(evokeds[ch].copy(),exclude=ica.exclude)
-                sfreq = int(evoked.info['sfreq'])
-                evoked_data = evoked.data[:,sfreq/10:-sfreq/10]
-                for i in range(evoked_data.shape[0]):
-                    evoked_data[i] -= np.median(evoked_data[i])
-                score += abs(evoked_data).sum()*evoked_data.std(axis=0).sum()
-            if min_score is None or score < min_score:
-                best_combo = combo
-                min_score = score
-        ica.exclude = [component for i,component in enumerate(components) if best_combo[i]]
+                evoked_data = cleaned[ch]
+                if component is not None:
+                    evoked_data = remove_component(evoked_data,ch,component)
+                evoked_data = evoked_data - np.median(evoked_data,axis=1,
+                                                      keepdims=True)
+                score += np.abs(evoked_data).sum()*evoked_data.std(axis=0).sum()
+            return score
+        # forward greedy selection, O(N^2) instead of trying all 2^N combinations
+        selected = []
+        remaining = set(components)
+        min_score = get_score()
+        while remaining:
+            candidates = {c:get_score(c) for c in tqdm(remaining)}
+            best = min(candidates,key=candidates.get)
+            if candidates[best] >= min_score:
+                break
+            min_score = candidates[best]
+            selected.append(best)
+            remaining.remove(best)
+            for ch in all_scores:
+                cleaned[ch] = remove_component(cleaned[ch],ch,best)
+        ica.exclude = sorted(selected)
         return ica
 
     def _make_ICA_components(self,raw,ica,eogs,ecgs,detrend,l_freq,h_freq,
                              kw,vis_tmin,vis_tmax):
-        if vis_tmin is not None:
-            raw = raw.copy().crop(tmin=vis_tmin)
-        if vis_tmax is not None:
-            raw = raw.copy().crop(tmax=vis_tmax)
+        if vis_tmin is not None or vis_tmax is not None:
+            raw = raw.copy().crop(tmin=vis_tmin if vis_tmin is not None else 0,
+                                  tmax=vis_tmax)
         all_scores = {}
         for ch in eogs:
             try:
@@ -407,9 +531,9 @@ class MEEGbuddy:
                 continue
             indices, scores = ica.find_bads_eog(epochs, ch_name=ch)
             all_scores[ch] = scores
-            if l_freq is not None or h_freq is not None:
-                epochs = epochs.filter(l_freq=l_freq,h_freq=h_freq)
             evoked = epochs.average()
+            if l_freq is not None or h_freq is not None:
+                evoked = _filter_inst(evoked,l_freq,h_freq)
             if detrend is not None:
                 evoked = evoked.detrend(detrend)
             self._save_evoked(evoked,'ica_%s' %(ch),keyword=kw)
@@ -423,14 +547,14 @@ class MEEGbuddy:
                 continue
             indices, scores = ica.find_bads_ecg(epochs)
             all_scores[ecg] = scores
-            if l_freq is not None or h_freq is not None:
-                epochs = epochs.filter(l_freq=l_freq,h_freq=h_freq)
             evoked = epochs.average()
+            if l_freq is not None or h_freq is not None:
+                evoked = _filter_inst(evoked,l_freq,h_freq)
             if detrend is not None:
                 evoked = evoked.detrend(detrend)
             self._save_evoked(evoked,'ica_%s' %(ecg),keyword=kw)
             self._exclude_ICA_components(ica,ecg,indices,scores)
-            return all_scores
+        return all_scores
 
     def _exclude_ICA_components(self,ica,ch,indices,scores):
         for ind in indices:
@@ -443,7 +567,7 @@ class MEEGbuddy:
         plt.close(fig)
 
     def plotICA(self,eogs=None,ecgs=None,preprocessed=False,event=None,ar=False,
-                keyword_in=None,keyword_out=None,show=True):
+                keyword_in=None,keyword_out=None,use_gpu=False,show=True):
         if event is None:
             inst = self._load_raw(preprocessed=preprocessed,keyword=keyword_in)
         else:
@@ -467,7 +591,7 @@ class MEEGbuddy:
                                       show=False)
             fig.show()
             ica.plot_sources(inst2,block=show,show=show,title=self.subject)
-            inst2 = ica.apply(inst2,exclude=ica.exclude)
+            inst2 = _apply_ica_fast(ica,inst2,copy=False,use_gpu=use_gpu)
             if isinstance(inst,BaseRaw):
                 for ch in eogs:
                     evoked = self._load_evoked('ica_%s' %(ch),keyword=kw)
@@ -505,57 +629,80 @@ class MEEGbuddy:
             fig.show()
 
     def getEvents(self,baseline=True):
-        if baseline:
-            return self.events.keys()
-        else:
-            return [event for event in self.events.keys() if event != 'Baseline']
+        return self._events_all if baseline else self._events_no_baseline
 
     def _save_epochs(self,epochs,event,ar=False,keyword=None):
-        print('Saving epochs for ' + event + ' autoreject'*ar +
-              ' %s' %(keyword)*(keyword is not None))
+        for key in [key for key in self._prepared_cache if key[0] == event]:
+            del self._prepared_cache[key]
+        self._epochs_cache.pop((event,ar,keyword),None)
+        self._dir_cache.pop('epochs',None)
+        print('Saving epochs for ' + event + _tag(' autoreject',ar) +
+              (' %s' %(keyword) if keyword is not None else ''))
         epochs.save(self._fname('epochs','epo','.fif',event,'ar'*ar,keyword))
 
     def _save_evoked(self,evoked,event,ar=False,keyword=None):
-        print('Saving evoked for ' + event + ' autoreject'*ar +
-              ' %s' %(keyword)*(keyword is not None))
+        self._dir_cache.pop('evoked',None)
+        print('Saving evoked for ' + event + _tag(' autoreject',ar) +
+              (' %s' %(keyword) if keyword is not None else ''))
         evoked.save(self._fname('evoked','ave','.fif',event,'ar'*ar,keyword))
 
-    def _load_epochs(self,event,ar=False,keyword=None):
+    def _load_epochs(self,event,ar=False,keyword=None,copy=True):
         fname = self._fname('epochs','epo','.fif',event,'ar'*ar,keyword)
-        if not os.path.isfile(fname):
+        if not self._isfile('epochs',fname):
             raise ValueError(event + ' epochs must be made first' +
-                             ' for autoreject'*ar +
-                             ' for %s' %(keyword)*(keyword is not None))
+                             _tag(' for autoreject',ar) +
+                             (' for %s' %(keyword)
+                              if keyword is not None else ''))
+        # keep the last few epochs read so plotting the same event again
+        # copies them in memory instead of reading and parsing the file,
+        # copy=False shares the cached epochs for callers that only read them
+        key = (event,ar,keyword)
+        if key in self._epochs_cache:
+            self._epochs_cache.move_to_end(key)
+            epochs = self._epochs_cache[key]
+            return epochs.copy() if copy else epochs
         epochs = read_epochs(fname,verbose=False,preload=True)
-        print('%s epochs loaded' %(event) + ' for autoreject'*ar +
-              ' for %s' %(keyword)*(keyword is not None))
+        print('%s epochs loaded' %(event) + _tag(' for autoreject',ar) +
+              (' for %s' %(keyword) if keyword is not None else ''))
+        if self._epochs_cache_size:
+            self._epochs_cache[key] = epochs.copy() if copy else epochs
+            if len(self._epochs_cache) > self._epochs_cache_size:
+                self._epochs_cache.popitem(last=False)
         return epochs
 
     def _load_evoked(self,event,ar=False,keyword=None):
         fname = self._fname('evoked','ave','.fif',event,'ar'*ar,keyword)
-        if not os.path.isfile(fname):
+        if not self._isfile('evoked',fname):
             raise ValueError(event + ' evoked must be made first' +
-                             ' for autoreject'*ar +
-                             ' for %s' %(keyword)*(keyword is not None))
+                             _tag(' for autoreject',ar) +
+                             (' for %s' %(keyword)
+                              if keyword is not None else ''))
         evoked = read_evokeds(fname,verbose=False)
-        print('%s epochs loaded' %(event) + ' for autoreject'*ar +
-              ' for %s' %(keyword)*(keyword is not None))
+        print('%s epochs loaded' %(event) + _tag(' for autoreject',ar) +
+              (' for %s' %(keyword) if keyword is not None else ''))
         return evoked[0]
 
     def _load_autoreject(self,event):
-        if os.path.isfile(self._fname('epochs','ar','.npz',event)):
+        if event in self._ar_log_cache:
+            return self._ar_log_cache[event]
+        if self._isfile('epochs',self._fname('epochs','ar','.npz',event)):
             f = np.load(self._fname('epochs','ar','.npz',event))
-            return f['ar'].item(),f['reject_log'].item()
+            self._ar_log_cache[event] = (f['ar'].item(),
+                                         f['reject_log'].item())
+            return self._ar_log_cache[event]
         else:
             print('Autoreject must be run for ' + event)
 
     def _save_autoreject(self,event,ar,reject_log):
-        np.savez_compressed(self._fname('epochs','ar','.npz',event),ar=ar,
-                            reject_log=reject_log)
+        self._ar_log_cache.pop(event,None)
+        self._dir_cache.pop('epochs',None)
+        self._savez(self._fname('epochs','ar','.npz',event),ar=ar,
+                    reject_log=reject_log)
 
     def _save_TFR(self,tfr,frequencies,n_cycles,
-                 event,condition,value,keyword,compressed=True):
+                 event,condition,value,keyword,compressed=False):
        print('Saving TFR for %s %s %s' %(event,condition,value))
+       self._dir_cache.pop('TFR',None)
        if compressed:
            np.savez_compressed(self._fname('TFR','tfr','.npz',event,condition,
                                            value,keyword),
@@ -573,11 +720,13 @@ class MEEGbuddy:
        fname1b = self._fname('TFR','tfr_params','.npz',event,condition,value,
                              keyword)
        fname2 = self._fname('TFR','tfr','.npz',event,condition,value,keyword)
-       if os.path.isfile(fname) and os.path.isfile(fname1b):
-           tfr = np.load(fname)
+       if self._isfile('TFR',fname1b) and self._isfile('TFR',fname):
+           # memory-mapped so slicing a band or time window doesn't read the
+           # whole array, copy before modifying in place
+           tfr = np.load(fname,mmap_mode='r')
            f = np.load(fname1b)
            frequencies,n_cycles = f['frequencies'],f['n_cycles']
-       elif os.path.isfile(fname2):
+       elif self._isfile('TFR',fname2):
            f = np.load(fname2)
            tfr,frequencies,n_cycles = f['tfr'],f['frequencies'],f['n_cycles']
        else:
@@ -589,21 +738,22 @@ class MEEGbuddy:
     def _save_CPT(self,event,condition,value,clusters,cluster_p_values,
                   times,frequencies=None,band=None):
         print('Saving CPT for %s %s %s' %(event,condition,value))
+        self._dir_cache.pop('CPT',None)
         if band:
-            np.savez_compressed(self._fname('CPT','CPT','.npz',event,condition,
-                                            value,band),
-                                clusters=clusters,
-                                cluster_p_values=cluster_p_values,band=band)
+            self._savez(self._fname('CPT','CPT','.npz',event,condition,
+                                    value,band),
+                        clusters=clusters,
+                        cluster_p_values=cluster_p_values,band=band)
         elif frequencies:
-            np.savez_compressed(self._fname('CPT','CPT','.npz',event,condition,
-                                            value,'tfr'),
-                                clusters=clusters,frequencies=frequencies,
-                                cluster_p_values=cluster_p_values)
+            self._savez(self._fname('CPT','CPT','.npz',event,condition,
+                                    value,'tfr'),
+                        clusters=clusters,frequencies=frequencies,
+                        cluster_p_values=cluster_p_values)
         else:
-            np.savez_compressed(self._fname('CPT','CPT','.npz',event,condition,
-                                            value),
-                                clusters=clusters,
-                                cluster_p_values=cluster_p_values)
+            self._savez(self._fname('CPT','CPT','.npz',event,condition,
+                                    value),
+                        clusters=clusters,
+                        cluster_p_values=cluster_p_values)
 
     def _load_CPT(self,event,condition,value,tfr=False,band=None):
         if band:
@@ -612,7 +762,7 @@ class MEEGbuddy:
             fname = self._fname('CPT','CPT','.npz',event,condition,value,'tfr')
         else:
             fname = self._fname('CPT','CPT','.npz',event,condition,value)
-        if os.path.isfile(fname):
+        if self._isfile('CPT',fname):
             f = np.load(fname)
             print('Cluster permuation test loaded for %s %s %s'
                   %(event,condition,value))
@@ -629,19 +779,20 @@ class MEEGbuddy:
     def _save_inverse(self,inv,lambda2,method,pick_ori,
                       event,condition,value,ar=False,keyword=None):
         print('Saving inverse for %s %s %s' %(event,condition,value))
+        self._dir_cache.pop('sources',None)
         write_inverse_operator(self._fname('sources','inv','.fif','ar'*ar,
                                            keyword,event,condition,value),
                                inv,verbose=False)
-        np.savez_compressed(self._fname('sources','inverse_params','.npz',
-                                        'ar'*ar,keyword,event,condition,value),
-                            lambda2=lambda2,method=method,pick_ori=pick_ori)
+        self._savez(self._fname('sources','inverse_params','.npz',
+                                'ar'*ar,keyword,event,condition,value),
+                    lambda2=lambda2,method=method,pick_ori=pick_ori)
 
     def _load_inverse(self,event,condition,value,ar=False,keyword=None):
         fname = self._fname('sources','inv','.fif','ar'*ar,keyword,event,
                             condition,value)
         fname2 = self._fname('sources','inverse_params','.npz','ar'*ar,
                             keyword,event,condition,value)
-        if os.path.isfile(fname) and os.path.isfile(fname2):
+        if self._isfile('sources',fname) and self._isfile('sources',fname2):
             f = np.load(fname2)
             return (read_inverse_operator(fname),f['lambda2'].item(),
                     f['method'].item(),f['pick_ori'].item())
@@ -650,6 +801,7 @@ class MEEGbuddy:
 
     def _save_source(self,stc,event,condition,value,ar=False,keyword=None,
                      fs_av=False):
+        self._dir_cache.pop('sources',None)
         if fs_av:
             print('Saving source fs average for %s %s %s' %(event,condition,
                                                             value))
@@ -664,8 +816,8 @@ class MEEGbuddy:
                      keyword=None):
         fname = self._fname('sources','source-lh','.stc','ar'*ar,keyword,event,
                             condition,value,'fs_av'*fs_av)
-        if os.path.isfile(fname):
-            print('Fs average s'*fs_av + 'S'*(not fs_av) + 'ource loaded for '+
+        if self._isfile('sources',fname):
+            print(('Fs average s' if fs_av else 'S') + 'ource loaded for ' +
                   '%s %s %s' %(event,condition,value))
             return read_source_estimate(fname)
         else:
@@ -674,20 +826,42 @@ class MEEGbuddy:
     def _save_PSD_image(self,image,preprocessed,ica,keyword,ch,N,deltaN,
                         fmin,fmax,NW):
         print('Saving psd multitaper image')
-        np.savez_compressed(self._fname('psd_multitaper','image','.npz',
-                            'preprocessed'*preprocessed,'ica'*ica,ch,
-                            'N_%i_dN_%.2f' %(N,deltaN),
-                            'fmin_%.2f_fmax_%.2f_NW_%i' %(fmin,fmax,NW)),
-                            image=image)
-
-    def _load_PSD_image(self,preprocessed,ica,keyword,ch,N,deltaN,fmin,fmax,NW):
-        fname = self._fname('psd_multitaper','image','.npz',
-                            'preprocessed'*preprocessed,'ica'*ica,ch,
-                            'N_%i_dN_%.2f' %(N,deltaN),
-                            'fmin_%.2f_fmax_%.2f_NW_%i' %(fmin,fmax,NW))
-        if os.path.isfile(fname):
+        self._dir_cache.pop('psd_multitaper',None)
+        # the image is already log10 power, float16 keeps ~3 significant
+        # digits which is well below what the colormap shows
+        image = image.astype(np.float16)
+        tags = ('preprocessed'*preprocessed,'ica'*ica,ch,
+                'N_%i_dN_%.2f' %(N,deltaN),
+                'fmin_%.2f_fmax_%.2f_NW_%i' %(fmin,fmax,NW))
+        if h5py is None:
+            np.savez_compressed(self._fname('psd_multitaper','image','.npz',
+                                            *tags),
+                                image=image)
+        else:
+            # chunked by blocks of windows with shuffle and lzf which are
+            # built into h5py and much faster to decompress than zlib
+            with h5py.File(self._fname('psd_multitaper','image','.h5',*tags),
+                           'w') as f:
+                f.create_dataset('image',data=image,shuffle=True,
+                                 compression='lzf',
+                                 chunks=(image.shape[0],
+                                         min(image.shape[1],1024)))
+
+    def _load_PSD_image(self,preprocessed,ica,keyword,ch,N,deltaN,fmin,fmax,NW,
+                        tmin=None,tmax=None):
+        # tmin and tmax are window indices, only those chunks are read
+        tags = ('preprocessed'*preprocessed,'ica'*ica,ch,
+                'N_%i_dN_%.2f' %(N,deltaN),
+                'fmin_%.2f_fmax_%.2f_NW_%i' %(fmin,fmax,NW))
+        fname = self._fname('psd_multitaper','image','.h5',*tags)
+        fname2 = self._fname('psd_multitaper','image','.npz',*tags)
+        if h5py is not None and self._isfile('psd_multitaper',fname):
+            print('Loading image')
+            with h5py.File(fname,'r') as f:
+                return f['image'][:,tmin:tmax].astype(np.float32)
+        elif self._isfile('psd_multitaper',fname2):
             print('Loading image')
-            return np.load(fname)['image']
+            return np.load(fname2)['image'][:,tmin:tmax].astype(np.float32)
         else:
             return None
 
@@ -700,44 +874,53 @@ class MEEGbuddy:
                                  mag=1e-11, # T (magnetometers)
                                  eeg=5e-4, # V (EEG channels)
                                  ),
-                     bad_seeds=0.25,seeds=1000,datalen=1000,
-                     overwrite=False):
+                     bad_seeds=0.25,seeds=1000,datalen=1000,mmap=False,
+                     n_jobs=None,overwrite=False):
         # now we will use seeding to remove bad channels
+        # note: mmap memory maps the raw data to a temporary file so that only
+        # the seed windows are paged in rather than holding it all in memory
+        # note: n_jobs is the number of threads used when numba isn't installed
         keyword_out = keyword_out if not keyword_out is None else keyword_in
-        if (os.path.isfile(self._fname('raw_preprocessed','raw','.fif',keyword_out)) and
+        if (self._isfile('raw_preprocessed',self._fname('raw_preprocessed','raw',
+                                                        '.fif',keyword_out)) and
             not overwrite):
            print('Raw data already marked for bads, use \'overwrite=True\'' +
                  ' to recalculate.')
            return
-        raw = self._load_raw(preprocessed=preprocessed,keyword=keyword_in)
+        mmap_fname = self._fname('raw_preprocessed','raw_mmap','.dat',keyword_in)
+        raw = self._load_raw(preprocessed=preprocessed,keyword=keyword_in,
+                             preload=mmap_fname if mmap else True)
+        if mmap and hasattr(raw._data,'_mmap') and hasattr(mmap_module,
+                                                           'MADV_RANDOM'):
+            # the seeds are random windows so read ahead is wasted
+            raw._data._mmap.madvise(mmap_module.MADV_RANDOM)
         data_types = ['grad','mag']*self.meg + ['eeg']*self.eeg
         bads = []
         rawlen = len(raw._data[0])
+        # the same windows for every channel, sorted so they are read in order
+        starts = np.sort(np.random.randint(0,rawlen-datalen,size=seeds))
         for dt in data_types:
             print(dt)
-            raw2 = raw.copy().pick_types(meg=dt if dt in ['grad','mag'] else False,
-                                         eeg=dt == 'eeg')
-            for i in range(len(raw2.ch_names)):
-                flat_count, reject_count = 0, 0
-                for j in range(seeds):
-                    start = np.random.randint(0,rawlen-datalen)
-                    seed = raw2._data[i, start:start+datalen]
-                    min_c = seed.min()
-                    max_c = seed.max()
-                    diff_c = max_c - min_c
-                    if diff_c < flat[dt]:
-                        flat_count += 1
-                    if diff_c > reject[dt]:
-                        reject_count += 1
+            # index the rows of the raw data rather than copying the raw
+            picks = pick_types(raw.info,meg=dt if dt in ['grad','mag'] else False,
+                               eeg=dt == 'eeg')
+            flat_counts,reject_counts = _seed_counts(raw._data,picks,starts,
+                                                     datalen,flat[dt],reject[dt],
+                                                     n_jobs=n_jobs)
+            for pick,flat_count,reject_count in zip(picks,flat_counts,
+                                                    reject_counts):
                 if flat_count > (seeds * bad_seeds):
-                    bads.append(raw2.ch_names[i])
-                    print(raw2.ch_names[i] + ' removed: flat')
+                    bads.append(raw.ch_names[pick])
+                    print(raw.ch_names[pick] + ' removed: flat')
                 elif reject_count > (seeds * bad_seeds):
-                    bads.append(raw2.ch_names[i])
-                    print(raw2.ch_names[i] + ' removed: reject')
+                    bads.append(raw.ch_names[pick])
+                    print(raw.ch_names[pick] + ' removed: reject')
 
         raw.info['bads'] = bads
         self._save_raw_preprocessed(raw,keyword=keyword_out)
+        if mmap:
+            del raw
+            os.remove(mmap_fname)
 
     def closePlots(self):
         plt.close('all')
@@ -745,25 +928,29 @@ class MEEGbuddy:
     def plotRaw(self,n_per_screen=20,scalings=None,preprocessed=False,
                 ica=False,keyword=None,l_freq=0.5,h_freq=40,
                 interpolate_bads=True,overwrite=False):
-        if (os.path.isfile(self._fname('raw_preprocessed','raw','.fif',keyword))
+        if (self._isfile('raw_preprocessed',self._fname('raw_preprocessed','raw',
+                                                        '.fif',keyword))
             and not overwrite):
             print('Use overwrite = True to overwrite')
             return
         raw = self._load_raw(preprocessed=preprocessed,ica=ica,keyword=keyword)
-        bads_ind = [raw.info['ch_names'].index(ch) for ch in raw.info['bads']]
-        this_chs_ind = list(pick_types(raw.info,meg=self.meg,eeg=self.eeg)) + bads_ind
-        aux_chs_ind = list(pick_types(raw.info,meg=False,eog=True,ecg=True))
-        order = []
+        ch_index = {ch:i for i,ch in enumerate(raw.info['ch_names'])}
+        bads_ind = [ch_index[ch] for ch in raw.info['bads']]
+        this_chs_ind = np.concatenate([pick_types(raw.info,meg=self.meg,
+                                                  eeg=self.eeg),
+                                       bads_ind]).astype(int)
+        aux_chs_ind = pick_types(raw.info,meg=False,eog=True,ecg=True)
+        # the aux channels are shown after every n channels on each screen
         n = n_per_screen-len(aux_chs_ind)
-        for i in range(len(this_chs_ind)//n+1):
-            order.append(this_chs_ind[i*n:min([len(this_chs_ind),(i+1)*n])])
-            order.append(aux_chs_ind)
-        order = np.concatenate(order)
+        n_screens = len(this_chs_ind)//n+1
+        screen_ends = np.minimum(np.arange(1,n_screens+1)*n,len(this_chs_ind))
+        order = np.insert(this_chs_ind,np.repeat(screen_ends,len(aux_chs_ind)),
+                          np.tile(aux_chs_ind,n_screens))
         if self.eeg:
             raw.set_eeg_reference(ref_channels=[],projection=False)
         elif self.meg:
             order = None
-        raw2 = raw.copy().filter(l_freq=l_freq,h_freq=h_freq)
+        raw2 = _filter_inst(raw.copy(),l_freq,h_freq)
         raw2.plot(show=True, block=True, color=dict(eog='steelblue'),
                  title="%s Bad Channel Selection" % self.subject, order=order,
                  scalings=scalings)
@@ -774,21 +961,29 @@ class MEEGbuddy:
 
     def makeEpochs(self,preprocessed=False,ica=False,keyword_in=None,
                    keyword_out=None,detrend=0,normalized=True,overwrite=False):
-        if (all([os.path.isfile(self._fname('epochs','epo','.fif',event,
-                                            keyword_out))
+        if (all([self._isfile('epochs',self._fname('epochs','epo','.fif',event,
+                                                   keyword_out))
                  for event in self.events]) and not overwrite):
             print('Epochs already made, use \'overwrite=True\' to recalculate.')
             return
         raw = self._load_raw(preprocessed=preprocessed,ica=ica,
                              keyword=keyword_in)
 
-        include = [i for i in range(self.n) if not (i in self.no_response or
-                   i in self.exclude_response)]
+        excluded = set(self.no_response) | set(self.exclude_response)
+        include = [i for i in range(self.n) if i not in excluded]
+        # events often share stim channels so only scan each channel once
+        stim_ch_events = {}
+        def get_events(stim_ch):
+            if stim_ch not in stim_ch_events:
+                stim_ch_events[stim_ch] = find_events(raw,stim_channel=stim_ch,
+                                                      output="onset",
+                                                      verbose=False)
+            return stim_ch_events[stim_ch]
+
         if normalized:
             # make baseline epochs
             baseline_ch,tmin,tmax = self.events['Baseline']
-            events = find_events(raw,stim_channel=baseline_ch,
-                                 output="onset",verbose=False)
+            events = get_events(baseline_ch)
             events = events[include,:]
             events[:,2] = include
 
@@ -800,14 +995,14 @@ class MEEGbuddy:
             baseline_data = bl_epochs.crop(tmin=tmin,tmax=tmax).get_data()
             baseline_arr = baseline_data.mean(axis=2)
 
+        exclude_response = set(self.exclude_response)
         include_response = [i for i in range(self.n) if
-                            i not in self.exclude_response]
+                            i not in exclude_response]
         include_response = include_response[:-len(self.no_response) or None]
 
         for event in self.getEvents(baseline=False):
             event_ch,tmin,tmax = self.events[event]
-            events = find_events(raw,stim_channel=event_ch,output="onset",
-                                 verbose=False)
+            events = get_events(event_ch)
             print('%s events found: %i' %(event,len(events)))
 
             expected_length = self.n-(event=='Response')*len(self.no_response)
@@ -836,9 +1031,9 @@ class MEEGbuddy:
             if normalized:
                 epochs_data = epochs.get_data()
                 info = epochs.info
-                epochs_demeaned_data = np.array([arr - baseline_arr.T
-                                                 for arr in epochs_data.T]).T
-                epochs = EpochsArray(epochs_demeaned_data,info,
+                # baseline is epochs x channels, broadcast over time in place
+                epochs_data -= baseline_arr[:,:,np.newaxis]
+                epochs = EpochsArray(epochs_data,info,
                                      events=events,verbose=False,
                                      proj=False,tmin=tmin-self.tbuffer)
             self._save_epochs(epochs,event,keyword=keyword_out)
@@ -849,26 +1044,21 @@ class MEEGbuddy:
         bl_epochs = self._load_epochs('Baseline',ar=ar,keyword=keyword_in)
 
         bl_value_indices = self._get_indices(bl_epochs,condition,values)
-        bl_values_dict = self._get_data(bl_epochs,values,bl_value_indices,tmin=None,
-                                        tmax=None,mean_and_std=False)
 
         epochs = self._load_epochs(event,ar=ar,keyword=keyword_in)
         value_indices = self._get_indices(epochs,condition,values)
-        epochs_data = epochs.get_data()
 
-        for value in values:
-            baseline_data = bl_values_dict[value]
-            baseline_arr = baseline_data.mean(axis=0).mean(axis=1) #average over epochs and times
-            indices = value_indices[value]
-            baseline_arr = np.tile(baseline_arr[np.newaxis,:,np.newaxis],
-                                   (len(indices),1,epochs_data.shape[2]))
-            epochs_data[indices] = epochs_data[indices] - baseline_arr
-        event_ch,tmin,tmax = self.events[event]
-
-        epochs_demeaned = EpochsArray(epochs_data,epochs.info,
-                                      events=epochs.events,verbose=False,
-                                      proj=False,tmin=epochs.tmin)
-        self._save_epochs(epochs_demeaned,event,keyword=keyword_out)
+        # only the baseline epochs of each value are read and the epochs are
+        # demeaned in place rather than copying the data into new epochs
+        baselines = np.array([bl_epochs._data[bl_value_indices[value]].mean(
+                              axis=0).mean(axis=1) for value in values]) #average over epochs and times
+        epochs_value = np.full(len(epochs),-1)
+        for i,value in enumerate(values):
+            epochs_value[value_indices[value]] = i
+        demean = epochs_value >= 0
+        epochs._data[demean] -= baselines[epochs_value[demean]][:,:,np.newaxis]
+
+        self._save_epochs(epochs,event,keyword=keyword_out)
         self._save_epochs(bl_epochs,'Baseline',keyword=keyword_out)
 
     def plotEpochs(self,event,n_epochs=20,n_channels=20,scalings=None,
@@ -878,7 +1068,7 @@ class MEEGbuddy:
         keyword_out = keyword_in if keyword_out is None else keyword_out
         epochs = self._load_epochs(event,ar=ar,keyword=keyword_in)
         if l_freq is not None or h_freq is not None:
-            epochs_copy = epochs.copy().filter(l_freq=l_freq,h_freq=h_freq)
+            epochs_copy = _filter_inst(epochs.copy(),l_freq,h_freq)
         if len(epochs.event_id) != len(epochs):
             event_id = epochs.event_id
             epochs.event_id = {str(i):i for i in range(len(epochs))}
@@ -954,28 +1144,47 @@ class MEEGbuddy:
                          tfr_keyword=None,contrast=False,tmin=None,tmax=None,
                          tfr=True,bands={'theta':(4,8),'alpha':(8,15),'beta':(15,30)},
                          vmin=None,vmax=None,contours=6,time_points=5,show=True):
+        # load the epochs and all the TFR frequencies once and slice each band
+        epochs = self._load_epochs(event,ar=ar,keyword=keyword)
+        values = self._default_values(values,condition,contrast)
+        value_indices = self._get_indices(epochs,condition,values)
+        tfr_data = self._get_tfr_data(event,condition,values,tfr_keyword,
+                                      value_indices,None,mean_and_std=False,
+                                      band_mean=False)
         for band in bands:
             self.plotTopomap(event,condition,values=values,ar=ar,keyword=keyword,
                              contrast=contrast,tmin=tmin,tmax=tmax,tfr=True,
                              tfr_keyword=tfr_keyword,
                              band_struct=(band,bands[band][0],bands[band][1]),
                              vmin=vmin,vmax=vmax,contours=contours,
-                             time_points=time_points,show=show)
+                             time_points=time_points,epochs=epochs,
+                             tfr_data=tfr_data,show=show)
 
     def plotTopomap(self,event,condition,values=None,ar=False,keyword=None,
                     tfr_keyword=None,contrast=False,tmin=None,tmax=None,tfr=False,
                     band_struct=None,vmin=None,vmax=None,
-                    contours=6,time_points=5,show=True):
-        epochs = self._load_epochs(event,ar=ar,keyword=keyword)
+                    contours=6,time_points=5,epochs=None,tfr_data=None,
+                    show=True):
+        # tfr_data is the (values_dict,frequencies) of _get_tfr_data without
+        # a band, to not reload the TFRs for each band
+        if epochs is None:
+            epochs = self._load_epochs(event,ar=ar,keyword=keyword)
         values = self._default_values(values,condition,contrast)
         value_indices = self._get_indices(epochs,condition,values)
         tmin,tmax = self._default_t(event,tmin,tmax)
         times = self._get_times(epochs,event,tmin=tmin,tmax=tmax)
         info = epochs.info
         band_title = '%s ' %(band_struct[0]) if band_struct is not None else ''
-        if tfr:
-            tind = np.array([i for i,t in enumerate(times) if
-                             t >= tmin and t<=tmax])
+        if tfr and tfr_data is not None:
+            values_dict,frequencies = tfr_data
+            if band_struct is not None:
+                _,fmin,fmax = band_struct
+                lo,hi = _sorted_range(frequencies,fmin,fmax)
+                values_dict = {value:values_dict[value][:,:,:,lo:hi]
+                               for value in values}
+                frequencies = frequencies[lo:hi]
+        elif tfr:
+            tind = np.arange(*_sorted_range(times,tmin,tmax))
             values_dict,frequencies = \
                 self._get_tfr_data(event,condition,values,tfr_keyword,value_indices,
                                    tind,band=band_struct,mean_and_std=False,
@@ -1040,6 +1249,7 @@ class MEEGbuddy:
                                                  ar=ar,keyword_in=keyword_in,
                                                  keyword_out=keyword_out)
         epochs = self._load_epochs(event,ar=ar,keyword=keyword_in)
+        bad_indices = set(bad_indices)
         good_indices = [i for i in range(self.n) if i not in bad_indices]
         epochs_indices = self._behavior_to_epochs_indices(epochs,good_indices)
         if keyword_out:
@@ -1146,14 +1356,26 @@ class MEEGbuddy:
     def _prepare_epochs(self,event,epochs,ar,keyword,tmin,tmax,
                         l_freq,h_freq):
         tmin,tmax = self._default_t(event,tmin,tmax)
+        # epochs loaded from file are filtered once and shared between plots
+        # with the same settings, callers only take averages so don't copy
+        key = (event,ar,keyword,tmin,tmax,l_freq,h_freq)
+        cache = (epochs is None and not isinstance(tmin,dict) and
+                 not isinstance(tmax,dict))
+        if cache and key in self._prepared_cache:
+            self._prepared_cache.move_to_end(key)
+            return self._prepared_cache[key]
         if epochs is None:
             epochs = self._load_epochs(event,ar=ar,keyword=keyword)
         else:
             epochs = epochs.copy()
         epochs = epochs.pick_types(meg=self.meg,eeg=self.eeg)
         if l_freq is not None or h_freq is not None:
-            epochs = epochs.filter(l_freq=l_freq,h_freq=h_freq)
+            epochs = _filter_inst(epochs,l_freq,h_freq)
         epochs = epochs.crop(tmin=tmin,tmax=tmax)
+        if cache:
+            self._prepared_cache[key] = epochs
+            if len(self._prepared_cache) > 4:
+                self._prepared_cache.popitem(last=False)
         return epochs
 
     def _default_t(self,event,tmin,tmax):
@@ -1187,39 +1409,42 @@ class MEEGbuddy:
         return vmin,vmax
 
     def _behavior_to_epochs_indices(self,epochs,indices):
-        return [self._behavior_to_epochs_index(epochs,i) for i in indices if
-                self._behavior_to_epochs_index(epochs,i)]
-
-    def _behavior_to_epochs_index(self,epochs,ind):
-        if ind in epochs.events[:,2]:
-            return list(epochs.events[:,2]).index(ind)
+        # the behavior index of each epoch is stored as its event id
+        epochs_index = {ind:i for i,ind in enumerate(epochs.events[:,2])}
+        return [epochs_index[i] for i in indices if i in epochs_index]
+
+    def _behavior_array(self,condition):
+        # cached as an array until the condition is reassigned
+        behavior = self.behavior[condition]
+        if (condition not in self._behavior_np or
+            self._behavior_np[condition][0] is not behavior):
+            self._behavior_np[condition] = (behavior,np.asarray(behavior))
+        return self._behavior_np[condition][1]
 
     def _get_binned_indices(self,epochs,condition,bins):
         bin_indices = {}
-        h,edges = np.histogram([cd for cd in self.behavior[condition] if not
-                                np.isnan(cd)],bins=bins)
+        arr = self._behavior_array(condition)
+        h,edges = np.histogram(arr[~np.isnan(arr)],bins=bins)
         for j in range(1,len(edges)):
-            indices = [i for i in range(self.n) if
-                       self.behavior[condition][i] >= edges[j-1] and
-                       self.behavior[condition][i] <= edges[j]]
+            indices = np.flatnonzero((arr >= edges[j-1]) &
+                                     (arr <= edges[j])).tolist()
             name = '%.2f-%.2f, count %i' %(edges[j-1],edges[j],len(indices))
             bin_indices[name] = self._behavior_to_epochs_indices(epochs,indices)
         return bin_indices
 
     def _get_indices(self,epochs,condition,values):
         value_indices = {}
-        if len(values) > 4 and all([istype(val,int) or istype(val,float)
-                                        for val in values]):
-            binsize = float(value[1] - value[0])
+        arr = self._behavior_array(condition)
+        binned = len(values) > 4 and all([isinstance(val,(int,float))
+                                          for val in values])
+        if binned:
+            binsize = float(values[1] - values[0])
         for value in values:
-            if len(values) > 4 and all([istype(val,int) or istype(val,float)
-                                        for val in values]):
-                indices = [i for i in range(self.n) if
-                           self.behavior[condition][i] >= value - binsize/2 and
-                           value + binsize/2 >= self.behavior[condition][i]]
+            if binned:
+                indices = np.flatnonzero((arr >= value - binsize/2) &
+                                         (value + binsize/2 >= arr)).tolist()
             else:
-                indices = [i for i in range(self.n) if
-                           self.behavior[condition][i] == value]
+                indices = np.flatnonzero(arr == value).tolist()
             epochs_indices = self._behavior_to_epochs_indices(epochs,indices)
             if epochs_indices:
                 value_indices[value] = epochs_indices
@@ -1269,18 +1494,16 @@ class MEEGbuddy:
         else:
             dim1 = int(np.ceil(np.sqrt(len(ch_dict))))
             dim2 = int(np.ceil(float(len(ch_dict))/dim1))
-            fig, ax_arr = plt.subplots(dim1,dim2,sharex=True,sharey=True)
+            fig, ax_arr = plt.subplots(dim1,dim2,sharex=True,sharey=True,
+                                       subplot_kw={'facecolor':'white',
+                                                   'frameon':False})
             fig.set_tight_layout(False)
             fig.subplots_adjust(left=0.1,right=0.9,top=0.9,bottom=0.1,
                                 wspace=0.05,hspace=0.05)
             ax_arr = ax_arr.flatten()
-            for i,ax in enumerate(ax_arr):
-                ax.set_facecolor('white')
-                ax.set_frame_on(False)
-                if i % dim1:
-                    ax.set_yticks([])
-                if i < len(ax_arr)-dim2:
-                    ax.set_xticks([])
+            n = len(ax_arr)
+            plt.setp([ax_arr[i] for i in range(n) if i % dim1],yticks=[])
+            plt.setp(ax_arr[:n-dim2],xticks=[])
         return fig, ax_arr
 
     def _get_ch_dict(self,inst,aux=False):
@@ -1292,11 +1515,17 @@ class MEEGbuddy:
 
     def _default_values(self,values,condition,contrast=False):
         if values is None:
-            values = np.unique([cd for cd in self.behavior[condition] if
-                                (type(cd) is str or type(cd) is np.string_ or
-                                 type(cd) is np.str_ or not np.isnan(cd))])
-            if (len(values) > 5 and
-                all([istype(val,int) or istype(val,float) for val in values])):
+            arr = self._behavior_array(condition)
+            if arr.dtype.kind == 'f':
+                mask = ~np.isnan(arr)
+            elif arr.dtype.kind == 'O':
+                # mixed column, only the float entries can be nan
+                mask = np.array([not (isinstance(cd,float) and np.isnan(cd))
+                                 for cd in arr],dtype=bool)
+            else:
+                mask = np.ones(arr.shape,dtype=bool)
+            values = np.unique(arr[mask])
+            if len(values) > 5 and np.issubdtype(values.dtype,np.number):
                values,edges = np.histogram(values,bins=5)
         if type(contrast) is list and len(contrast) == 2:
             values = contrast
@@ -1308,7 +1537,7 @@ class MEEGbuddy:
                       band=None,mean_and_std=True, band_mean=True):
         values_dict = {}
         frequencies_old = None
-        for value in values:
+        for i,value in enumerate(values):
             epochs_data,frequencies,_ = self._load_TFR(event,condition,value,
                                                        keyword)
             epochs_data = np.swapaxes(epochs_data,2,3)
@@ -1317,28 +1546,31 @@ class MEEGbuddy:
                                  'frequencies')
             if band is not None:
                 band_name,fmin,fmax = band
-                band_indices = [index for index in range(len(frequencies)) if
-                                frequencies[index] >= fmin and
-                                frequencies[index] <= fmax]
-                epochs_std = \
-                    np.sqrt(epochs_data[:,:,:,band_indices].mean(axis=3)**2 +
-                            epochs_data[:,:,:,band_indices].std(axis=3)**2)
-                epochs_data = epochs_data[:,:,:,band_indices]
+                # frequencies are sorted so the band is a slice (a view)
+                lo = np.searchsorted(frequencies,fmin,side='left')
+                hi = np.searchsorted(frequencies,fmax,side='right')
+                epochs_data = epochs_data[:,:,:,lo:hi]
+                band_data_mean = epochs_data.mean(axis=3)
+                epochs_std = np.hypot(band_data_mean,epochs_data.std(axis=3))
                 if band_mean:
-                    epochs_data = epochs_data.mean(axis=3)
+                    epochs_data = band_data_mean
             if mean_and_std:
+                if i == 0:
+                    # contiguous values x channels x ... blocks as in _get_data
+                    means = np.empty((len(values),) + epochs_data.shape[1:])
+                    stds = np.empty_like(means)
                 if band is None:
-                    epochs_std = np.sqrt(epochs_data.mean(axis=0)**2+
-                                         epochs_data.std(axis=0)**2)
+                    np.hypot(epochs_data.mean(axis=0),epochs_data.std(axis=0),
+                             out=stds[i])
                 else:
-                    epochs_std = np.sqrt(epochs_std.mean(axis=0)**2+
-                                         epochs_std.std(axis=0)**2)
-                epochs_mean = epochs_data.mean(axis=0)
-                values_dict[value] = (epochs_mean,epochs_std)
+                    np.hypot(epochs_std.mean(axis=0),epochs_std.std(axis=0),
+                             out=stds[i])
+                epochs_data.mean(axis=0,out=means[i])
+                values_dict[value] = (means[i],stds[i])
             else:
                 values_dict[value] = epochs_data
         if band is not None:
-            frequencies = [f for f in frequencies if f > band[1] and f < band[2]]
+            frequencies = frequencies[lo:hi]
         return values_dict,frequencies
 
     def _get_data(self,epochs,values,value_indices,tmin,tmax,mean_and_std=True):
@@ -1346,22 +1578,24 @@ class MEEGbuddy:
             tmin = min(tmin.values())
         if type(tmax) is dict:
             tmax = max(tmax.values())
-        epochs = epochs.copy().crop(tmin=tmin,tmax=tmax)
-        epochs_data = epochs.get_data()
-        if mean_and_std:
-            epochs_std = epochs_data.std(axis=0)
-            epochs_mean = epochs_data.mean(axis=0)
-            values_dict = {'all':(epochs_mean,epochs_std)}
-        else:
+        # a view of the time window instead of cropping a copy of the epochs
+        i0,i1 = epochs.time_as_index([tmin,tmax],use_rounding=True)
+        epochs_data = epochs.get_data()[:,:,max(i0,0):i1+1]
+        if not mean_and_std:
             values_dict = {'all':epochs_data}
-        for value in values:
-            indices = value_indices[value]
-            if mean_and_std:
-                epochs_std = epochs_data[indices].std(axis=0)
-                epochs_mean = epochs_data[indices].mean(axis=0)
-                values_dict[value] = (epochs_mean,epochs_std)
-            else:
-                values_dict[value] = epochs_data[indices]
+            for value in values:
+                values_dict[value] = epochs_data[value_indices[value]]
+            return values_dict
+        # the means and stds of all the values are stored contiguously
+        # (values x channels x times) and the dict holds views into them
+        means = np.empty((len(values)+1,) + epochs_data.shape[1:])
+        stds = np.empty_like(means)
+        values_dict = {}
+        for i,value in enumerate(['all'] + list(values)):
+            value_data = (epochs_data if i == 0 else
+                          epochs_data[_as_slice(value_indices[value])])
+            _mean_std(value_data,means[i],stds[i])
+            values_dict[value] = (means[i],stds[i])
         return values_dict
 
     def _get_times(self,epochs,event,buffered=False,tmin=None,tmax=None):
@@ -1377,8 +1611,10 @@ class MEEGbuddy:
         if type(tmax) is dict:
             tmax = max(tmax.values())
         times = epochs.times
-        tind = np.intersect1d(np.where(tmin<=times),np.where(times<=tmax))
-        return times[tind]
+        # times are sorted so the window is a contiguous slice
+        i0 = np.searchsorted(times,tmin,side='left')
+        i1 = np.searchsorted(times,tmax,side='right')
+        return times[i0:i1]
 
     def getEventTimes(self,event):
         '''do this on the events from the raw since we don't want to have any
@@ -1405,12 +1641,12 @@ class MEEGbuddy:
         values = self._default_values(values,condition,contrast)
         value_indices = self._get_indices(epochs,condition,values)
         ch_dict = self._get_ch_dict(epochs,aux=aux)
+        ch_idx = np.fromiter(ch_dict.keys(),dtype=np.intp)
         fig,axs = self._setup_plot(ch_dict,butterfly=butterfly,values=values)
         tmin,tmax = self._default_t(event,tmin,tmax)
         times = self._get_times(epochs,event,tmin=tmin,tmax=tmax)
         if tfr:
-            tind = np.array([i for i,t in enumerate(times) if
-                             t >= tmin and t<=tmax])
+            tind = np.arange(*_sorted_range(times,tmin,tmax))
             values_dict,frequencies = \
                 self._get_tfr_data(event,condition,values,tfr_keyword,
                                    value_indices,tind,band=band)
@@ -1420,11 +1656,11 @@ class MEEGbuddy:
         if contrast:
             epochs_mean0,epochs_std0 = values_dict[values[0]]
             epochs_mean1,epochs_std1 = values_dict[values[1]]
-            epochs_std = np.sqrt(epochs_std0**2 + epochs_std1**2)
+            epochs_std = np.hypot(epochs_std0,epochs_std1)
             epochs_mean = epochs_mean1-epochs_mean0
             self._plot_decider(epochs_mean,epochs_std,times,axs,fig,butterfly,
                                contrast,values,ch_dict,tfr,band,frequencies,
-                               vmin,vmax)
+                               vmin,vmax,ch_idx=ch_idx)
         else:
             for i,value in enumerate(values):
                 epochs_mean,epochs_std = values_dict[value]
@@ -1432,11 +1668,13 @@ class MEEGbuddy:
                     axs[i].set_title(value)
                     self._plot_decider(epochs_mean,epochs_std,times,axs[i],fig,
                                        butterfly,contrast,values,ch_dict,tfr,
-                                       band,frequencies,vmin,vmax)
+                                       band,frequencies,vmin,vmax,
+                                       ch_idx=ch_idx)
                 else:
                     self._plot_decider(epochs_mean,epochs_std,times,axs,fig,
                                        butterfly,contrast,values,ch_dict,tfr,
-                                       band,frequencies,vmin,vmax)
+                                       band,frequencies,vmin,vmax,
+                                       ch_idx=ch_idx)
         if not (heatmap or butterfly):
             if contrast:
                 self._add_last_square_legend(fig,'%s-%s' %(values[0],values[1]))
@@ -1449,55 +1687,70 @@ class MEEGbuddy:
 
     def _plot_decider(self,epochs_mean,epochs_std,times,axs,fig,butterfly,
                       contrast,values,ch_dict,tfr,band,frequencies,vmin,vmax,
-                      clusters=None,cluster_p_values=None):
-        vmin,vmax = self._default_vs(epochs_mean[ch_dict.keys()],
-                                     epochs_std[ch_dict.keys()],vmin,vmax)
+                      clusters=None,cluster_p_values=None,ch_idx=None):
+        if ch_idx is None:
+            ch_idx = np.fromiter(ch_dict.keys(),dtype=np.intp)
+        vmin,vmax = self._default_vs(epochs_mean[ch_idx],epochs_std[ch_idx],
+                                     vmin,vmax)
         if tfr:
             if band is not None:
                 self._plot_band(epochs_mean,epochs_std,times,axs,ch_dict,
-                                butterfly,vmin,vmax,clusters=clusters,
+                                ch_idx,butterfly,vmin,vmax,clusters=clusters,
                                 cluster_p_values=cluster_p_values)
             else:
                 self._plot_heatmap(epochs_mean,epochs_std,times,axs,fig,
-                                   butterfly,ch_dict,frequencies,vmin,vmax,
-                                   clusters=clusters,
+                                   butterfly,ch_dict,ch_idx,frequencies,
+                                   vmin,vmax,clusters=clusters,
                                    cluster_p_values=cluster_p_values)
         else:
             self._plot_voltage(epochs_mean,epochs_std,times,axs,butterfly,
-                               ch_dict,vmin,vmax,clusters=clusters,
+                               ch_dict,ch_idx,vmin,vmax,clusters=clusters,
                                cluster_p_values=cluster_p_values)
 
     def _plot_voltage(self,epochs_mean,epochs_std,times,axs,butterfly,ch_dict,
-                      vmin,vmax,clusters=None,cluster_p_values=None):
-        epochs_mean *= 1e6
-        epochs_std *= 1e6
-        vmin *= 1e6
-        vmax *= 1e6
+                      ch_idx,vmin,vmax,clusters=None,cluster_p_values=None):
+        # scale copies of the plotted channels to uV rather than the
+        # caller's arrays, which would be rescaled on every plot
+        vmin = vmin*1e6
+        vmax = vmax*1e6
+        means_sub = epochs_mean[ch_idx]
+        means_sub *= 1e6
+        means_sub -= means_sub.mean(axis=1,keepdims=True)
+        if butterfly:
+            # all the channels as one artist instead of a line each
+            axs.add_collection(LineCollection(_line_segments(times,means_sub),
+                                              colors='k'))
+            axs.set_xlim(times[0],times[-1])
+            axs.axvline(0,color='k')
+            axs.set_ylim(vmin,vmax)
+            self._plot_clusters(axs,times,clusters,cluster_p_values)
+            return
+        stds_sub = epochs_std[ch_idx]
+        stds_sub *= 1e6
         for i,ch in enumerate(ch_dict):
-            if butterfly:
-                ax = axs
-            else:
-                ax = axs[i]
-                ax.set_title(ch_dict[ch])
+            ax = axs[i]
+            ax.set_title(ch_dict[ch])
             ax.axvline(0,color='k')
             ax.set_ylim(vmin,vmax)
-            v = epochs_mean[ch]-epochs_mean[ch].mean()
+            v = means_sub[i]
             lines = ax.plot(times,v,color='k')
-            if not butterfly:
-                ax.fill_between(times,v-epochs_std[ch],v+epochs_std[ch],
-                                color=lines[0].get_color(),alpha=0.5)
-            if clusters and cluster_p_values:
-                for i_c, c in enumerate(clusters):
-                    c = c[0]
-                    if cluster_p_values[i_c] <= 0.05:
-                        h = ax.axvspan(time[c.start],time[c.stop - 1],color='r',
-                                       alpha=0.3)
-                    else:
-                        ax.axvspan(time[c.start],time[c.stop-1],
-                                   color=(0.3, 0.3, 0.3),alpha=0.3)
+            ax.fill_between(times,v-stds_sub[i],v+stds_sub[i],
+                            color=lines[0].get_color(),alpha=0.5)
+            self._plot_clusters(ax,times,clusters,cluster_p_values)
+
+    def _plot_clusters(self,ax,times,clusters,cluster_p_values):
+        if clusters and cluster_p_values:
+            for i_c, c in enumerate(clusters):
+                c = c[0]
+                if cluster_p_values[i_c] <= 0.05:
+                    ax.axvspan(times[c.start],times[c.stop-1],color='r',
+                               alpha=0.3)
+                else:
+                    ax.axvspan(times[c.start],times[c.stop-1],
+                               color=(0.3, 0.3, 0.3),alpha=0.3)
 
     def _plot_heatmap(self,epochs_mean,epochs_std,times,axs,fig,butterfly,
-                      ch_dict,frequencies,vmin,vmax,clusters=None,
+                      ch_dict,ch_idx,frequencies,vmin,vmax,clusters=None,
                       cluster_p_values=None):
         cmap = plt.get_cmap('cool')
         norm = SymLogNorm(vmax/10,vmin=vmin,vmax=vmax)
@@ -1505,6 +1758,9 @@ class MEEGbuddy:
         fmin,fmax = frequencies.min(),frequencies.max()
         extent=[tmin,tmax,fmin,fmax]
         aspect=1.0/(fmax-fmin)
+        if not clusters:
+            # normalize and color all the channels in one call
+            rgba = cmap(norm(epochs_mean[ch_idx,::-1]))
         for i,ch in enumerate(ch_dict):
             if butterfly:
                 ax = axs
@@ -1524,8 +1780,7 @@ class MEEGbuddy:
                 image[:,:,1:2] = 0
                 ax.imshow(current_data,aspect=aspect,norm=norm,extent=extent)
             else:
-                current_data = cmap(norm(epochs_mean[ch,::-1]))
-                im = ax.imshow(current_data,aspect=aspect,extent=extent,
+                im = ax.imshow(rgba[i],aspect=aspect,extent=extent,
                                cmap=cmap,norm=norm)
             ax.set_xticks(np.round(np.linspace(tmin,tmax,5),2))
             frequency_labels = np.round(frequencies[::10],2)
@@ -1533,30 +1788,28 @@ class MEEGbuddy:
         cbar_ax = fig.add_axes([0.92, 0.1, 0.05, 0.8])
         fig.colorbar(im, cax=cbar_ax)
 
-    def _plot_band(self,epochs_mean,epochs_std,times,axs,ch_dict,butterfly,
-                   vmin,vmax,clusters=None,cluster_p_values=None):
+    def _plot_band(self,epochs_mean,epochs_std,times,axs,ch_dict,ch_idx,
+                   butterfly,vmin,vmax,clusters=None,cluster_p_values=None):
+        if butterfly:
+            colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+            axs.add_collection(LineCollection(
+                _line_segments(times,epochs_mean[ch_idx]),
+                colors=colors))
+            axs.set_xlim(times[0],times[-1])
+            axs.axvline(0,color='k')
+            axs.set_ylim(vmin,vmax)
+            self._plot_clusters(axs,times,clusters,cluster_p_values)
+            return
         for i,ch in enumerate(ch_dict):
-            if butterfly:
-                ax = axs
-            else:
-                ax = axs[i]
-                ax.set_title(ch_dict[ch])
+            ax = axs[i]
+            ax.set_title(ch_dict[ch])
             lines = ax.plot(times,epochs_mean[ch])
-            if not butterfly:
-                ax.fill_between(times,epochs_mean[ch]-epochs_std[ch],
-                                epochs_mean[ch]+epochs_std[ch],
-                                color=lines[0].get_color(),alpha=0.5)
+            ax.fill_between(times,epochs_mean[ch]-epochs_std[ch],
+                            epochs_mean[ch]+epochs_std[ch],
+                            color=lines[0].get_color(),alpha=0.5)
             ax.axvline(0,color='k')
             ax.set_ylim(vmin,vmax)
-            if clusters and cluster_p_values:
-                for i_c, c in enumerate(clusters):
-                    c = c[0]
-                    if cluster_p_values[i_c] <= 0.05:
-                        h = ax.axvspan(times[c.start],times[c.stop-1],color='r',
-                                       alpha=0.3)
-                    else:
-                        ax.axvspan(timse[c.start],times[c.stop-1],
-                                   color=(0.3, 0.3, 0.3),alpha=0.3)
+            self._plot_clusters(ax,times,clusters,cluster_p_values)
 
     def _prepare_fig(self,fig,event,condition,values,aux=False,
                      butterfly=False,contrast=False,tfr=False,band=None,
@@ -1573,7 +1826,7 @@ class MEEGbuddy:
         fig.set_size_inches(20,15)
         title = (event + ' ' + condition + ' ' +
                  ' '.join([str(value) for value in values]) +
-                 ' contrast'*contrast)
+                 _tag(' contrast',contrast))
         if tfr and band:
             bandname,_,_ = band
             title += (' ' + bandname + ' band')
@@ -1588,8 +1841,10 @@ class MEEGbuddy:
 
     def makeWavelets(self,event,condition,values=None,ar=False,keyword_in=None,
                      keyword_out=None,fmin=3,fmax=35,nmin=3,nmax=10,steps=32,
-                     compressed=False,normalize=True,overwrite=False):
+                     compressed=False,normalize=True,use_gpu=False,
+                     overwrite=False):
         #note compression may not always work
+        #note use_gpu does the wavelet convolutions with cupy if installed
         values = self._default_values(values,condition,contrast=False)
         frequencies = np.logspace(np.log10(fmin),np.log10(fmax),steps)
         n_cycles = np.logspace(np.log10(nmin),np.log10(nmax),steps)
@@ -1608,33 +1863,32 @@ class MEEGbuddy:
                                             bl_tmin-self.tbuffer,
                                             bl_tmax+self.tbuffer,mean_and_std=False)
         for value in values:
+            ext = '.npz' if compressed else '.npy'
             if (overwrite or not
-                (os.path.isfile(self._fname('TFR','tfr','.npz',
-                                            'Baseline',condition,value)) and
-                 os.path.isfile(self._fname('TFR','tfr','.npz',
-                                            event,condition,value)))):
+                (os.path.isfile(self._fname('TFR','tfr',ext,'Baseline',
+                                            condition,value,keyword_out)) and
+                 os.path.isfile(self._fname('TFR','tfr',ext,event,condition,
+                                            value,keyword_out)))):
                 if normalize:
-                    bl_tfr = tfr_array_morlet(bl_values_dict[value],
-                                              sfreq=bl_epochs.info['sfreq'],
-                                              freqs=frequencies,n_cycles=n_cycles,
-                                              output='power')
                     bl_tind = bl_epochs.time_as_index(bl_times) #crop buffer
-                    bl_tfr = bl_tfr[:,:,:,bl_tind]
+                    bl_tfr = _compute_tfr_fast(bl_values_dict[value],
+                                               frequencies,n_cycles,
+                                               bl_epochs.info['sfreq'],
+                                               use_gpu=use_gpu,tind=bl_tind)
                     self._save_TFR(bl_tfr,frequencies,n_cycles,'Baseline',condition,
                                    value,keyword_out,compressed=compressed)
                     bl_power = bl_tfr.mean(axis=0).mean(axis=-1) #average over epochs,times
                     bl_power = bl_power[np.newaxis,:,:,np.newaxis]
                 current_data = values_dict[value]
-                current_data -= current_data.mean(axis=0)
-                tfr = tfr_array_morlet(current_data,sfreq=epochs.info['sfreq'],
-                                       freqs=frequencies,n_cycles=n_cycles,
-                                       output='power')
+                np.subtract(current_data,
+                            current_data.mean(axis=0,keepdims=True),
+                            out=current_data)
                 tind = epochs.time_as_index(times) #crop buffer
-                tfr = tfr[:,:,:,tind]
+                tfr = _compute_tfr_fast(current_data,frequencies,n_cycles,
+                                        epochs.info['sfreq'],use_gpu=use_gpu,
+                                        tind=tind)
                 if normalize:
-                    tile_shape = (current_data.shape[0],1,1,len(times))
-                    bl_power = np.tile(bl_power,tile_shape)
-                    tfr /= bl_power #normalize
+                    tfr /= bl_power #normalize, broadcast over epochs and times
                 self._save_TFR(tfr,frequencies,n_cycles,event,condition,value,
                                keyword_out,compressed=compressed)
                 del tfr
@@ -1670,26 +1924,28 @@ class MEEGbuddy:
 
         if image is None:
             imsize = int(Fs/2*N) + 1
-            image = np.zeros((imsize,int(n_full_windows*(N/deltaN))))
-            counters = np.zeros((int(n_full_windows*(N/deltaN))))
-            with Parallel(n_jobs=n_jobs) as parallel:
-                results = parallel(delayed(tsa.multi_taper_psd)(
-                            raw_data[int(round(i*deltaN*Fs)):
-                                     int(round((i*deltaN+N)*Fs))],
-                            Fs=Fs,NW=NW,BW=BW,adaptive=adaptive,
-                            jackknife=jackknife,low_bias=low_bias)
-                                    for i in tqdm(range(n_windows)))
-            fs, psd_mts, nus = zip(*results)
-            for i in range(n_windows):
-                for j in range(i,i+int(N/deltaN)):
-                    image[:,j] += np.log10(psd_mts[i])
-                    counters[j] += 1
-            for k in range(imsize):
-                image[k] /= counters
+            win_len = int(round(N*Fs))
+            # every window starts at its own rounded sample so the starts
+            # don't drift when deltaN*Fs isn't a whole number of samples,
+            # each batch gathers its rows from the read-only hop 1 view
+            windows = _sliding_windows(raw_data,win_len,1)
+            starts = np.round(np.arange(n_windows)*deltaN*Fs).astype(int)
+            psd_mts = np.empty((n_windows,win_len//2 + 1))
+            # the tapers are the same for every window so solve them once
+            dpss,eigvals = _multitaper_tapers(win_len,Fs,NW,BW,low_bias)
+            # threads share raw_data and write their rows of psd_mts
+            # instead of pickling the windows and the results
+            with Parallel(n_jobs=n_jobs,require='sharedmem') as parallel:
+                parallel(delayed(_multitaper_batch)(
+                    windows[starts[i:i+64]],psd_mts[i:i+64],dpss,eigvals,Fs,
+                    adaptive=adaptive)
+                         for i in tqdm(range(0,n_windows,64)))
+            image = _spectrogram_image(np.log10(psd_mts,out=psd_mts),
+                                       int(N/deltaN),
+                                       int(n_full_windows*(N/deltaN)))
             f = np.linspace(0,Fs/2,imsize)
-            f_inds = [i for i,freq in enumerate(f) if
-                      (freq >= fmin and freq <= fmax)]
-            image = image[f_inds]
+            lo,hi = _sorted_range(f,fmin,fmax)
+            image = image[lo:hi]
             self._save_PSD_image(image,preprocessed,ica,keyword,ch,
                                  N,deltaN,fmin,fmax,NW)
 
@@ -1752,12 +2008,19 @@ class MEEGbuddy:
     def assignConditionFromStateTimes(self,event,condition,state_times,
                                       no_state='Neither'):
         event_times = self.getEventTimes(event)
-        states = np.tile(no_state,len(event_times))
-        for i,t in enumerate(event_times):
-            for state in state_times:
-                if any([t <= tmax and t >= tmin for
-                        tmin,tmax in state_times[state]]):
-                    states[i] = state
+        width = max([len(str(label)) for label in list(state_times) + [no_state]])
+        states = np.full(len(event_times),no_state,dtype='U%i' %(width))
+        for state in state_times:
+            if not len(state_times[state]):
+                continue
+            # an event is in a state if the interval with the last start
+            # before it (or any earlier one) has not ended yet
+            intervals = np.asarray(state_times[state],dtype=float)
+            intervals = intervals[np.argsort(intervals[:,0])]
+            ends = np.maximum.accumulate(intervals[:,1])
+            last = np.searchsorted(intervals[:,0],event_times,side='right') - 1
+            inside = (last >= 0) & (event_times <= ends[np.maximum(last,0)])
+            states[inside] = state
         self.behavior[condition] = states
         self._save_behavior()
 
@@ -1821,8 +2084,7 @@ class MEEGbuddy:
             bl_value_indices = self._get_indices(bl_epochs,condition,values)
         ch_dict = self._get_ch_dict(epochs,aux=aux)
         if tfr:
-            tind = np.array([i for i,t in enumerate(times) if
-                             t >= tmin and t<=tmax])
+            tind = np.arange(*_sorted_range(times,tmin,tmax))
             values_dict,frequencies = \
                 self._get_tfr_data(event,condition,values,tfr_keyword,value_indices,
                                    tind,band=band,mean_and_std=False)
@@ -1857,44 +2119,63 @@ class MEEGbuddy:
                                cluster_p_values,times,
                                frequencies=frequencies,band=band)
 
-    def _equalize_baseline_length(value_data,bl_data):
+    def _equalize_baseline_length(self,value_data,bl_data):
         bl_len = bl_data.shape[-1]
         val_len = value_data.shape[-1]
         if bl_len < val_len:
-            n_reps = val_len/bl_len
+            n_reps = val_len//bl_len
             remainder = val_len% bl_len
             print('Using %.2f ' %(n_reps + float(remainder)/bl_len) +
                   'repetitions of the baseline period for permuation')
-            baseline = np.tile(bl_data,n_reps)
-            remainder_baseline = np.take(bl_data,
-                                         range(bl_len-remainder,bl_len),
-                                         axis=-1)
-                              #take from the end of the baseline period
-            bl_data = np.concatenate((baseline,remainder_baseline),axis=-1)
-        elif bl_len > ep_len:
-            bl_data = np.take(bl_data,range(val_len),axis=-1)
+            # repeats and the remainder taken from the end of the baseline
+            # period in a single copy
+            bl_data = np.concatenate([bl_data]*n_reps +
+                                     [bl_data[...,bl_len-remainder:]],axis=-1)
+        elif bl_len > val_len:
+            bl_data = bl_data[...,:val_len]
         return bl_data
 
     def _CPT(self,data0,data1,threshold,n_permutations=1000,n_jobs=10):
-        T_obs, clusters, cluster_p_values, H0 = \
-        permutation_cluster_test([data0,data1],n_permutations=n_permutations,
-                                  threshold=threshold,tail=0,n_jobs=n_jobs,
-                                  buffer_size=None,verbose=False)
+        # have mne's joblib memmap the data for the workers (in shared
+        # memory if possible) instead of pickling a copy to each of them
+        mem_config = {'MNE_MEMMAP_MIN_SIZE':'1M'}
+        if os.path.isdir('/dev/shm'):
+            mem_config['MNE_CACHE_DIR'] = '/dev/shm'
+        old_config = {key:os.environ.get(key) for key in mem_config}
+        os.environ.update(mem_config)
+        try:
+            T_obs, clusters, cluster_p_values, H0 = \
+            permutation_cluster_test([data0,data1],n_permutations=n_permutations,
+                                      threshold=threshold,tail=0,n_jobs=n_jobs,
+                                      buffer_size=1000,verbose=False)
+        finally:
+            for key,value in old_config.items():
+                if value is None:
+                    os.environ.pop(key,None)
+                else:
+                    os.environ[key] = value
         return clusters,cluster_p_values
 
     def plotControlVariables(self,conditions=None):
         if conditions is None:
             conditions = list(self.behavior.keys())
+        # one frame so the checks used by all the plots are column operations
+        df = DataFrame({param:self.behavior[param] for param in conditions},
+                       columns=conditions)
+        is_str = {param:df[param].map(type).eq(str).any()
+                  for param in conditions}
+        not_nan = df.notna()
+        iscat = {param:is_str[param] or df[param].nunique(dropna=True) > 5
+                 for param in conditions}
         for param in conditions:
             fig,(ax1,ax2) = plt.subplots(1,2)
-            if any([isinstance(self.behavior[param][index],str)
-                    for index in range(self.n)]):
+            if is_str[param]:
                 sns.countplot(self.behavior[param],ax=ax1)
                 sns.swarmplot(x=range(self.n),y=self.behavior[param],ax=ax2)
             else:
-                var = [v for v in self.behavior[param] if not np.isnan(v)]
-                t = [i for i,v in enumerate(self.behavior[param]) if not
-                        np.isnan(v)]
+                var = df[param].dropna().astype(float)
+                t = var.index.values
+                var = var.values
                 sns.distplot(var,bins=10,ax=ax1)
                 ax2 = sns.pointplot(x=t,y=var,join=False,ax=ax2)
             ax1.set_title('Histogram')
@@ -1909,12 +2190,8 @@ class MEEGbuddy:
         for i in range(len(conditions)):
             for j in range(i+1,len(conditions)):
                 fig,ax = plt.subplots()
-                iscat1 = (any([isinstance(self.behavior[params[i]][index],str)
-                              for index in range(self.n)]) or
-                          len(np.unique(self.behavior[params[i]]))>5)
-                iscat2 = (any([isinstance(self.behavior[params[j]][index],str)
-                              for index in range(self.n)]) or
-                          len(np.unique(self.behavior[params[j]]))>5)
+                iscat1 = iscat[params[i]]
+                iscat2 = iscat[params[j]]
                 if iscat1 and iscat2:
                     sns.countplot(x=self.behavior[params[i]],
                                   hue=self.behavior[params[j]],ax=ax)
@@ -1924,14 +2201,10 @@ class MEEGbuddy:
                     sns.violinplot(x=self.behavior[params[i]],
                                   y=self.behavior[params[j]])
                 else:
-                    indices = [index for index in range(self.n) if not
-                               (np.isnan(self.behavior[params[i]][index]) or
-                                np.isnan(self.behavior[params[j]][index]))]
-                    column1 = [self.behavior[params[i]][index]
-                               for index in indices]
-                    column2 = [self.behavior[params[j]][index]
-                               for index in indices]
-                    heatmat = np.histogram2d(column1,column2,bins=9)
+                    mask = (not_nan[params[i]] & not_nan[params[j]]).values
+                    column1 = df[params[i]].values[mask].astype(float)
+                    column2 = df[params[j]].values[mask].astype(float)
+                    heatmat = _histogram2d(column1,column2,bins=9)
                     centers1 = (heatmat[1][:-1] +
                                 float(heatmat[1][1]-heatmat[1][0])/2)
                     centers1 = [round(c,2) for c in centers1]
@@ -1948,8 +2221,10 @@ class MEEGbuddy:
 
     def markAutoReject(self,event,keyword=None,bad_ar_threshold=0.5,n_jobs=10,
                        n_interpolates=[1,2,3,5,7,10,20],random_state=89,
-                       consensus_percs=np.linspace(0,1.0,11),overwrite=False):
-        if (os.path.isfile(self._fname('epochs','epo','.fif',event,'ar')) and
+                       consensus_percs=np.linspace(0,1.0,11),
+                       thresh_method='bayesian_optimization',overwrite=False):
+        if (self._isfile('epochs',self._fname('epochs','epo','.fif',event,
+                                              'ar')) and
             not overwrite):
            print('Autoreject already calculated, use \'overwrite=True\' to '+
                  'recalculate.')
@@ -1957,18 +2232,30 @@ class MEEGbuddy:
         epochs = self._load_epochs(event,keyword=keyword)
         picks = pick_types(epochs.info,meg=self.meg,eeg=self.eeg,stim=False,
                            eog=False,exclude=epochs.info['bads'])
-        ar = AutoReject(n_interpolates,consensus_percs,
-                        picks=picks,random_state=random_state,
-                        n_jobs=n_jobs,verbose='tqdm')
-        epochs_ar, reject_log = ar.fit_transform(epochs,return_log=True)
+        # the fit is the slow part so reuse it if these exact epochs with these
+        # parameters were already fit, e.g. when overwriting
+        key = (hashlib.sha1(np.ascontiguousarray(epochs._data)).hexdigest(),
+               tuple(picks),tuple(n_interpolates),tuple(consensus_percs),
+               random_state,thresh_method)
+        if key in self._ar_cache:
+            ar = self._ar_cache[key]
+            epochs_ar, reject_log = ar.transform(epochs,return_log=True)
+        else:
+            ar = AutoReject(n_interpolates,consensus_percs,
+                            picks=picks,random_state=random_state,
+                            thresh_method=thresh_method,
+                            n_jobs=n_jobs,verbose='tqdm')
+            epochs_ar, reject_log = ar.fit_transform(epochs,return_log=True)
+            self._ar_cache[key] = ar
         rejected = float(sum(reject_log.bad_epochs))/len(epochs)
         print('\n\n\n\n\n\nAutoreject rejected %.0f%% of epochs\n\n\n\n\n\n'%(100*rejected))
         self._save_epochs(epochs_ar,event,ar=True)
         self._save_autoreject(event,ar,reject_log)
 
     def plotAutoReject(self,event,keyword=None,ylim=dict(eeg=(-15, 15)),show=True):
-        epochs_ar = self._load_epochs(event,ar=True)
-        epochs_comparison = self._load_epochs(event,keyword=keyword)
+        epochs_ar = self._load_epochs(event,ar=True,copy=False)
+        epochs_comparison = self._load_epochs(event,keyword=keyword,
+                                              copy=False)
         ar,reject_log = self._load_autoreject(event)
 
         set_matplotlib_defaults(plt, style='seaborn-white')
@@ -2025,15 +2312,17 @@ class MEEGbuddy:
     def epochs2source(self,fs_dir,bemf,sourcef,coord_transf,
                       event,condition,values=None,snr=1.0,ar=False,
                       keyword_in=None,keyword_out=None,method='dSPM',
-                      pick_ori='normal',shared_baseline=False,overwrite=False):
+                      pick_ori='normal',shared_baseline=False,n_jobs=1,
+                      overwrite=False):
         keyword_out = keyword_in if keyword_out is None else keyword_out
         values = self._default_values(values,condition)
         epochs = self._load_epochs(event,ar=ar,keyword=keyword_in)
         bl_epochs = self._load_epochs('Baseline',ar=ar,keyword=keyword_in)
         value_indices = self._get_indices(epochs,condition,values)
 
-        if (all([os.path.isfile(self._fname('sources','source-lh','.stc',event,
-                                            condition,value))
+        if (all([self._isfile('sources',self._fname('sources','source-lh',
+                                                    '.stc',event,condition,
+                                                    value))
                  for value in values]) and not overwrite):
             print('Sources already computed, use \'overwrite=True\' ' +
                   'to recalculate')
@@ -2043,41 +2332,91 @@ class MEEGbuddy:
             self._source_setup(fs_dir,bemf,sourcef,coord_transf,event,snr,
                                epochs,bl_epochs)
 
+        # the rank is the same for every value so don't estimate it per inverse
+        rank = self._data_rank(bl_epochs)
         if shared_baseline:
             print('Making inverse for all...')
             inv = self._generate_inverse(epochs,fwd,bl_epochs,lambda2,method,
-                                         pick_ori)
+                                         pick_ori,rank=rank)
             self._save_inverse(inv,lambda2,method,pick_ori,
                                event,condition,'all',ar,keyword_out)
             print('Applying inverse on baseline for all...')
+            bl_evoked = bl_epochs.average()
             bl_stc = apply_inverse(bl_evoked,inv,lambda2=lambda2,method=method,
                                    pick_ori=pick_ori)
             self._save_source(bl_stc,'Baseline',condition,'all',ar,keyword_out)
-        else:
-            bl_value_indices = self._get_indices(bl_epochs,condition,values)
-        for value in values:
-            if not shared_baseline:
-                if not value in bl_value_indices: #if the baseline was corrupted,
-                    continue                      #don't use the trial
-                bl_indices = bl_value_indices[value]
-                print('Making inverse for %s...' %(value))
-                inv = self._generate_inverse(epochs,fwd,bl_epochs[bl_indices],
-                                             lambda2,method,pick_ori)
-                self._save_inverse(inv,lambda2,method,pick_ori,
-                                   event,condition,value,ar,keyword_out)
-                print('Applying inverse on baseline for %s...' %(value))
-                bl_evoked = bl_epochs[bl_indices].average()
-                bl_stc = apply_inverse(bl_evoked,inv,lambda2=lambda2,
-                                       method=method,pick_ori=pick_ori)
-                self._save_source(bl_stc,'Baseline',condition,value,ar,
-                                  keyword_out)
-            print('Applying inverse for %s' %(value))
-            indices = value_indices[value]
-            current_epochs = epochs[indices]
-            evoked = current_epochs.average()
-            stc = apply_inverse(evoked,inv,lambda2=lambda2,method=method,
-                                pick_ori=pick_ori)
-            self._save_source(stc,event,condition,value,ar,keyword_out)
+            evokeds = {value:epochs[value_indices[value]].average()
+                       for value in values}
+            # the noise normalization depends on nave so only values with
+            # the same number of trials can share an inverse application
+            for nave in sorted(set(evk.nave for evk in evokeds.values())):
+                these_values = [value for value in values
+                                if evokeds[value].nave == nave]
+                print('Applying inverse for %s' %(', '.join(
+                    [str(value) for value in these_values])))
+                stcs = self._apply_inverse_stacked(
+                    [evokeds[value] for value in these_values],inv,lambda2,
+                    method,pick_ori)
+                for value,stc in zip(these_values,stcs):
+                    self._save_source(stc,event,condition,value,ar,
+                                      keyword_out)
+            return
+        bl_value_indices = self._get_indices(bl_epochs,condition,values)
+        # the values are independent, the covariances and inverses are
+        # mostly lapack so threads run them in parallel on the same data
+        with Parallel(n_jobs=n_jobs,require='sharedmem') as parallel:
+            parallel(delayed(self._value_source)(
+                epochs,bl_epochs,fwd,value,value_indices[value],
+                bl_value_indices.get(value),event,condition,lambda2,method,
+                pick_ori,rank,ar,keyword_out)
+                     for value in values)
+
+    def _apply_inverse_stacked(self,evokeds,inv,lambda2,method,pick_ori):
+        # one inverse application on the evokeds concatenated in time
+        # instead of one small matrix product per evoked
+        n_times = len(evokeds[0].times)
+        evoked = EvokedArray(np.concatenate([evk.data for evk in evokeds],
+                                            axis=1),
+                             evokeds[0].info,tmin=evokeds[0].times[0],
+                             nave=evokeds[0].nave)
+        stc = apply_inverse(evoked,inv,lambda2=lambda2,method=method,
+                            pick_ori=pick_ori)
+        return [stc.__class__(stc.data[...,i*n_times:(i+1)*n_times],
+                              stc.vertices,stc.tmin,stc.tstep,
+                              subject=stc.subject)
+                for i in range(len(evokeds))]
+
+    def _inverse_kernel(self,inv,info,nave,lambda2,method,pick_ori):
+        # the inverse is linear with normal orientations so applying it to
+        # the identity gives the sources x channels matrix it multiplies
+        # data over the channels of info (averaged nave times) by
+        evoked = EvokedArray(np.eye(len(info['ch_names'])),info,nave=nave,
+                             verbose=False)
+        return apply_inverse(evoked,inv,lambda2=lambda2,method=method,
+                             pick_ori=pick_ori,verbose=False).data
+
+    def _value_source(self,epochs,bl_epochs,fwd,value,indices,bl_indices,
+                      event,condition,lambda2,method,pick_ori,rank,ar,
+                      keyword_out):
+        if bl_indices is None: #if the baseline was corrupted,
+            return             #don't use the trial
+        print('Making inverse for %s...' %(value))
+        inv = self._generate_inverse(epochs,fwd,bl_epochs[bl_indices],
+                                     lambda2,method,pick_ori,rank=rank)
+        self._save_inverse(inv,lambda2,method,pick_ori,
+                           event,condition,value,ar,keyword_out)
+        print('Applying inverse on baseline for %s...' %(value))
+        bl_evoked = bl_epochs[bl_indices].average()
+        bl_stc = apply_inverse(bl_evoked,inv,lambda2=lambda2,
+                               method=method,pick_ori=pick_ori)
+        self._save_source(bl_stc,'Baseline',condition,value,ar,
+                          keyword_out)
+        print('Applying inverse for %s' %(value))
+        current_epochs = epochs[indices]
+        evoked = current_epochs.average()
+        stc = apply_inverse(evoked,inv,lambda2=lambda2,method=method,
+                            pick_ori=pick_ori)
+        self._save_source(stc,event,condition,value,ar,keyword_out)
 
     def _source_setup(self,fs_dir,bemf,sourcef,coord_transf,event,snr,
                       epochs,bl_epochs):
@@ -2110,11 +2449,21 @@ class MEEGbuddy:
                                     meg=self.meg,eeg=self.eeg,mindist=1.0)
         return bem,source,coord_trans,lambda2,epochs,bl_epochs,fwd
 
-    def _generate_inverse(self,epochs,fwd,bl_epochs,lambda2,method,pick_ori):
+    def _generate_inverse(self,epochs,fwd,bl_epochs,lambda2,method,pick_ori,
+                          rank=None):
         noise_cov = compute_covariance(bl_epochs,method="shrunk")
-        inv = make_inverse_operator(epochs.info, fwd, noise_cov)
+        inv = make_inverse_operator(epochs.info, fwd, noise_cov, rank=rank)
         return inv
 
+    def _data_rank(self,epochs):
+        # estimated from the data since removed ica components and an
+        # applied average reference lower it without leaving projectors
+        picks = pick_types(epochs.info,meg=self.meg,eeg=self.eeg,
+                           exclude='bads')
+        data = epochs.get_data()[:,picks]
+        return estimate_rank(np.concatenate(data,axis=-1),tol='auto',
+                             norm=True)
+
     def fsaverageMorph(self,event,condition,values=None,ar=False,keyword=None):
         values = self._default_values(values,condition)
         for value in values:
@@ -2160,9 +2509,10 @@ class MEEGbuddy:
             np.random.seed(seed)
         for value in values:
             if use_saved_stc:
-                if not os.path.isfile(self._fname('sources','source-lh','.stc',
-                                                  event,condition,value,
-                                                  'fs_av'*fs_av)):
+                if not self._isfile('sources',
+                                    self._fname('sources','source-lh','.stc',
+                                                event,condition,value,
+                                                'fs_av'*fs_av)):
                     raise ValueError('The data must be converted to' +
                                      ' source space first.')
                 stc = self._load_source(event,condition,value,fs_av,ar=ar,
@@ -2173,8 +2523,9 @@ class MEEGbuddy:
                 if downsample:
                     print('Subsampling %i/%i ' %(nTR,len(indices)) +
                           'for %s %s.' %(condition,value))
-                    np.random.shuffle(indices)
-                    indices = sorted(indices[:nTR])
+                    # sample without shuffling the value's indices in place
+                    indices = np.sort(np.random.choice(indices,nTR,
+                                                       replace=False))
                 inv,lambda2,method,pick_ori = \
                     self._load_inverse(event,condition,value,ar=ar,keyword=keyword)
                 stc_Evoked = epochs[indices].average()
@@ -2227,20 +2578,14 @@ class MEEGbuddy:
                                        tmax=tmax,mode=mode,stim_channel=stim_ch)
 
         inst_data = inst.copy().get_data()
-        if mode == 'spline':
-            ch_ind = pick_types(inst.info,meg=self.meg,eeg=self.eeg,
-                                eog=True,ecg=True,stim=False)
-        else:
-            ch_ind = pick_types(inst.info,meg=self.meg,eeg=self.eeg,
-                                eog=True,ecg=True,stim=False)
+        ch_ind = pick_types(inst.info,meg=self.meg,eeg=self.eeg,
+                            eog=True,ecg=True,stim=False)
         if isinstance(inst,BaseEpochs):
             event_ind = np.where(inst.times==0)[0][0]
-            interp_data = np.zeros(inst_data.shape)
-            for i in range(inst_data.shape[0]):
-                epoch_data = inst_data[i]
-                interp_data[i] = self._interpolate(epoch_data,ch_ind,
-                                                   [event_ind],npoint_art,
-                                                   offset,points,k)
+            # the event is at the same sample in every epoch so all the
+            # epochs are interpolated together
+            interp_data = self._interpolate(inst_data,ch_ind,[event_ind],
+                                            npoint_art,offset,points,k)
             interp_spline = EpochsArray(interp_data,inst.info,events=inst.events,
                                         tmin=inst.tmin,verbose=False)
         else:
@@ -2280,11 +2625,12 @@ class MEEGbuddy:
         event_ind = np.where(times==0)[0][0]
         left_edge = event_ind-offset
         right_edge = event_ind+npoint_art-offset
-        base0 = range(left_edge-points,left_edge)
-        base1 = range(right_edge,right_edge+points)
-        interp_ind = range(left_edge,right_edge)
-        other0 = range(0,left_edge-points)
-        other1 = range(right_edge+points,len(times))
+        base0 = np.arange(left_edge-points,left_edge)
+        base1 = np.arange(right_edge,right_edge+points)
+        interp_ind = np.arange(left_edge,right_edge)
+        other0 = np.arange(0,left_edge-points)
+        other1 = np.arange(right_edge+points,len(times))
+        other_ind = np.concatenate([other0,other1])
         this_ind = pick_types(epochs.info,meg=self.meg,eeg=self.eeg)
         aux_ind = pick_types(epochs.info,meg=False,ecg=True,eog=True)
         evoked_data = epochs.get_data().mean(axis=0)
@@ -2292,16 +2638,18 @@ class MEEGbuddy:
         fig,(ax1,ax2) = plt.subplots(2,1)
         fig.suptitle('Evoked Colored By Interpolation Parameters')
         for ax,ch_ind in zip([ax1,ax2],[this_ind,aux_ind]):
-            for ch,interp_ch in zip(evoked_data[ch_ind],interp_data[ch_ind]):
-                ch_mean = ch[list(other0)+list(other1)].mean(axis=0)
-                interp_ch_mean = interp_ch[list(other0)+list(other1)].mean(axis=0)
-                ax.plot(times[other0],ch[other0]-ch_mean,color='k')
-                ax.plot(times[other1],ch[other1]-ch_mean,color='k')
-                ax.plot(times[interp_ind],ch[interp_ind]-ch_mean,color='r')
-                ax.plot(times[interp_ind],interp_ch[interp_ind]-
-                                          interp_ch_mean,color='g')
-                ax.plot(times[base0],ch[base0]-ch_mean,color='b')
-                ax.plot(times[base1],ch[base1]-ch_mean,color='b')
+            # demean all the channels at once and plot each segment for all
+            # of them in one call (channels as columns)
+            ev = evoked_data[ch_ind]
+            ev = (ev - ev[:,other_ind].mean(axis=1,keepdims=True)).T
+            iv = interp_data[ch_ind]
+            iv = (iv - iv[:,other_ind].mean(axis=1,keepdims=True)).T
+            ax.plot(times[other0],ev[other0],color='k')
+            ax.plot(times[other1],ev[other1],color='k')
+            ax.plot(times[interp_ind],ev[interp_ind],color='r')
+            ax.plot(times[interp_ind],iv[interp_ind],color='g')
+            ax.plot(times[base0],ev[base0],color='b')
+            ax.plot(times[base1],ev[base1],color='b')
             ax.set_xlabel('Time (s)')
             ax.set_ylabel('V')
             ax.set_ylim(ylim)
@@ -2313,20 +2661,21 @@ class MEEGbuddy:
         return interp2,inst
 
     def _interpolate(self,this_data,ch_ind,events,npoint_art,offset,points,k):
+        # this_data is channels x times or epochs x channels x times
         for event in events:
             left_edge = event-offset
             right_edge = event+npoint_art-offset
-            x = np.concatenate((range(left_edge-points,left_edge),
-                                range(right_edge,right_edge+points)))
+            x = np.concatenate((np.arange(left_edge-points,left_edge),
+                                np.arange(right_edge,right_edge+points)))
             xnew = np.arange(left_edge,right_edge)
-            y = np.concatenate((this_data[ch_ind,left_edge-points:left_edge],
-                                this_data[ch_ind,right_edge:right_edge+points]),
-                                axis=1)
-            ynew = np.zeros((y.shape[0],xnew.shape[0]))
-            for i in range(len(y)):
-                tck = interpolate.splrep(x, y[i,:], s=0.0, k=k)
-                ynew[i,:] = interpolate.splev(xnew, tck, der=0)
-            this_data[ch_ind,left_edge:right_edge] = ynew
+            y = np.concatenate((this_data[...,ch_ind,left_edge-points:left_edge],
+                                this_data[...,ch_ind,right_edge:right_edge+points]),
+                                axis=-1)
+            # one interpolating spline solve for all channels (and epochs)
+            # at once since they share x (the same not-a-knot spline as
+            # splrep with s=0)
+            spline = interpolate.make_interp_spline(x,y,k=k,axis=-1)
+            this_data[...,ch_ind,left_edge:right_edge] = spline(xnew)
         return this_data
 
     def applyInterpolation(self,inst,event=None,keyword_out='Interpolated'):
@@ -2338,22 +2687,23 @@ class MEEGbuddy:
             self._save_raw_preprocessed(inst,keyword=keyword_out)
 
     def filterEpochs(self,event,ar=False,keyword_in=None,keyword_out=None,
-                     h_freq=None,l_freq=None):
+                     h_freq=None,l_freq=None,n_jobs=-1):
         epochs = self._load_epochs(event,ar=ar,keyword=keyword_in)
-        epochs = epochs.copy().filter(h_freq=h_freq,l_freq=l_freq)
+        epochs = _filter_inst(epochs,l_freq,h_freq,n_jobs=n_jobs)
         if keyword_out:
             ar = False
         self._save_epochs(epochs,event,ar=ar,keyword=keyword_out)
 
     def filterRaw(self,preprocessed=False,ica=False,keyword_in=None,
-                  keyword_out=None,l_freq=None,h_freq=None,maxwell=False):
+                  keyword_out=None,l_freq=None,h_freq=None,maxwell=False,
+                  n_jobs=-1):
         keyword_out = keyword_out if keyword_out is not None else keyword_in
         raw = self._load_raw(preprocessed=preprocessed,ica=ica,
                              keyword=keyword_in)
         if maxwell:
             raw = maxwell_filter(raw)
         else:
-            raw = raw.filter(l_freq=l_freq,h_freq=h_freq)
+            raw = _filter_inst(raw,l_freq,h_freq,n_jobs=n_jobs)
         if keyword_out:
             ica = False
         self._save_raw_preprocessed(raw,ica=ica,keyword=keyword_out)
@@ -2363,13 +2713,21 @@ class MEEGbuddy:
                         pick_ori='normal',tfr=True,itc=True,
                         fmin=7,fmax=35,nmin=3,nmax=10,steps=7,
                         bands={'alpha':(7,15),'beta':(15,35)},
-                        Nboot=1000,Nave=50,seed=13,n_jobs=10,
-                        use_fft=True,mode='same',batch=10,overwrite=False):
+                        Nboot=1000,Nave=50,seed=13,n_jobs=1,
+                        use_fft=True,mode='same',batch=10,use_gpu=False,
+                        shared_baseline=False,overwrite=False):
         ''' You need enough bootstraps to get a good normal distribution
             of your condition value means, 250 seems to do good. Nave is
             a tradeoff between more extreme values and lower snr of source
             estimates. Nboot is better the greater the number but 100 is
-            approximately 40 GB with tfr'''
+            approximately 40 GB with tfr. use_gpu does the wavelet
+            convolutions with cupy if installed (same mode with FFTs).
+            shared_baseline uses one inverse from all the baseline epochs
+            instead of one from each bootstrap's baselines, which with
+            normal orientations is a single matrix product per bootstrap.
+            Each of the n_jobs bootstraps run at once holds its own source
+            tfr, power and phase, a few GB each with tfr on a full source
+            space, so only raise n_jobs if the memory allows it.'''
         freqs = np.logspace(np.log10(fmin),np.log10(fmax),steps)
         band_inds = {band:[i for i,f in enumerate(freqs) if
                      f >= bands[band][0] and f <= bands[band][1]]
@@ -2379,96 +2737,184 @@ class MEEGbuddy:
         keyword_out = keyword_in if keyword_out is None else keyword_out
         fname = self._fname('sources','bootstrap','.npz',event,
                             'ar'*(ar and not keyword_out),keyword_out)
-        if os.path.isfile(fname) and not overwrite:
+        if self._isfile('sources',fname) and not overwrite:
             raise ValueError('Bootstraps already exist, use overwrite=True')
         np.random.seed(seed)
         epochs = self._load_epochs(event,ar=ar,keyword=keyword_in)
         bl_epochs = self._load_epochs('Baseline',ar=ar,keyword=keyword_in)
-        removal_indices = []
-        for j,i in enumerate(epochs.events[:,2]):
-            if not i in bl_epochs.events[:,2]:
-                removal_indices.append(j)
+        removal_indices = np.flatnonzero(~np.isin(epochs.events[:,2],
+                                                  bl_epochs.events[:,2]))
         epochs = epochs.drop(removal_indices)
-        bootstrap_indices = np.random.randint(0,len(epochs),(Nboot,Nave))
+        bootstrap_indices = np.random.randint(0,len(epochs),(Nboot,Nave),
+                                              dtype=np.int32)
+        # averages don't depend on the order, sorted gathers read the
+        # epochs data in order
+        bootstrap_indices.sort(axis=1)
 
         bem,source,coord_trans,lambda2,epochs,bl_epochs,fwd = \
             self._source_setup(fs_dir,bemf,sourcef,coord_transf,event,snr,
                                epochs,bl_epochs)
         events = epochs.events[:,2]
         bl_events = bl_epochs.events[:,2]
-
-        stcs = np.memmap('sb_%s_%s_%s_workfile' %(event,ar,keyword_out),
-                 dtype='float64', mode='w+',
-                 shape=(batch,fwd['nsource'],len(epochs.times)))
+        # the baseline epoch of each epoch, looked up once for all bootstraps
+        bl_index = {ev:i for i,ev in enumerate(bl_events)}
+        events_to_bl = np.array([bl_index[ev] for ev in events],dtype=int)
+        rank = self._data_rank(bl_epochs)
+        if shared_baseline:
+            inv = self._generate_inverse(epochs,fwd,bl_epochs,lambda2,method,
+                                         pick_ori,rank=rank)
+            # the kernel has to be over the channels the averages keep
+            # (the data channels), not all the channels of the epochs
+            kernel = (self._inverse_kernel(inv,epochs[:1].average().info,
+                                           Nave,lambda2,method,pick_ori)
+                      if pick_ori == 'normal' else None)
+
+        # one work file per array (the band arrays used to share a file)
+        # in float32 (float16 for the bounded itc phases), opened once and
+        # reused for every batch
+        workfile = 'sb_%s_%s_%s_%s_workfile.npy'
+        work_shape = (batch,fwd['nsource'],len(epochs.times))
+        stcs = open_memmap(workfile %('stc',event,ar,keyword_out),mode='w+',
+                           dtype=np.float32,shape=work_shape)
         if tfr:
             Ws = mne.time_frequency.morlet(epochs.info['sfreq'],
                                                freqs, n_cycles=n_cycles,
                                                zero_mean=False)
-            powers = {band:np.memmap('sb_tfr_%s_%s_%s_workfile' %(event,ar,keyword_out),
-                                     dtype='float64', mode='w+',
-                                     shape=(batch,fwd['nsource'],len(epochs.times)))
+            # the same mode FFT convolution is batched over the sources
+            # with the wavelet FFTs computed once for all the bootstraps,
+            # in single precision since the powers are stored as float32
+            fast_cwt = use_gpu or (use_fft and mode == 'same')
+            if fast_cwt:
+                wavelet_ffts = _wavelet_ffts(Ws,len(epochs.times),
+                                             _get_xp(use_gpu),
+                                             dtype=np.complex64)
+            powers = {band:open_memmap(workfile %('power_' + band,event,ar,
+                                                  keyword_out),
+                                       mode='w+',dtype=np.float32,
+                                       shape=work_shape)
                       for band in bands}
             if itc:
-                itcs = {band:np.memmap('sb_tfr_%s_%s_%s_workfile' %(event,ar,keyword_out),
-                                        dtype='float64', mode='w+',
-                                        shape=(batch,fwd['nsource'],len(epochs.times)))
+                itcs = {band:open_memmap(workfile %('itc_' + band,event,ar,
+                                                    keyword_out),
+                                         mode='w+',dtype=np.float16,
+                                         shape=work_shape)
                       for band in bands}
             else:
                 itcs = None
         else:
             powers = itcs = Ws = None
+
+        def one_bootstrap(i,k):
+            indices = bootstrap_indices[k]
+            evoked = epochs[indices].average()
+            if shared_baseline and kernel is not None:
+                stc_data = kernel.dot(evoked.data)
+            else:
+                this_inv = (inv if shared_baseline else
+                            self._generate_inverse(
+                                epochs,fwd,bl_epochs[events_to_bl[indices]],
+                                lambda2,method,pick_ori,rank=rank))
+                stc_data = apply_inverse(evoked,this_inv,lambda2=lambda2,
+                                         method=method,pick_ori=pick_ori).data
+            stcs[i] = stc_data
+            if tfr:
+                if fast_cwt:
+                    this_tfr = _cwt_fast(stc_data,Ws,use_gpu=use_gpu,
+                                         wavelet_ffts=wavelet_ffts,
+                                         dtype=np.complex64)
+                else:
+                    this_tfr = mne.time_frequency.tfr.cwt(stc_data.copy(),
+                                                          Ws,use_fft=use_fft,
+                                                          mode=mode)
+                if itc:
+                    this_itc = np.angle(this_tfr)
+                # squared magnitude into float32 (the dtype it's stored in)
+                # instead of a complex product, squaring the imaginary
+                # parts in place since the phases are already taken
+                power = np.square(this_tfr.real,
+                                  out=np.empty(this_tfr.shape,
+                                               dtype=np.float32))
+                power += np.square(this_tfr.imag,out=this_tfr.imag)
+                for band,inds in band_inds.items():
+                    powers[band][i] = power[:,inds].mean(axis=1)
+                    if itc:
+                        itcs[band][i] = this_itc[:,inds].mean(axis=1)
+
         mins = range(0,Nboot-batch +1,batch)
         maxs = range(batch,Nboot+1,batch)
         for i_min,i_max in zip(mins,maxs):
             print('Computing bootstraps %i to %i' %(i_min,i_max))
-            fname2 = self._fname('sources','bootstrap','.npz',
-                                '%i-%i' %(i_min,i_max),event,
-                                'ar'*(ar and not keyword_out),keyword_out)
-            if os.path.isfile(fname2) and not overwrite:
+            if (self._bootstrap_batch_exists(i_min,i_max,event,ar,keyword_out)
+                and not overwrite):
                 continue
-            for i,k in enumerate(tqdm(range(i_min,i_max))):
-                indices = bootstrap_indices[k]
-                bl_indices = [np.where(bl_events == j)[0][0]
-                              for j in events[indices]]
-                inv = self._generate_inverse(epochs,fwd,bl_epochs[bl_indices],
-                                             lambda2,method,pick_ori)
-                evoked = epochs[indices].average()
-                stc = apply_inverse(evoked,inv,lambda2=lambda2,method=method,
-                                           pick_ori=pick_ori)
-                stcs[i] = stc.data[:]
-                if tfr:
-                    this_tfr = mne.time_frequency.tfr.cwt(stc.data.copy(),Ws,
-                                                          use_fft=use_fft,
-                                                          mode=mode)
-                    power = (this_tfr * this_tfr.conj()).real
-                    if itc:
-                        this_itc = np.angle(this_tfr)
-                    for band,inds in band_inds.items():
-                        powers[band][i] = power[:,inds].mean(axis=1)
-                        if itc:
-                            itcs[band][i] = this_itc[:,inds].mean(axis=1)
-            np.savez_compressed(fname2,stcs=stcs)
+            # the bootstraps of a batch are independent and write their own
+            # rows, the inverses and transforms are mostly lapack and FFTs
+            # so threads run them in parallel on the same arrays
+            with Parallel(n_jobs=n_jobs,require='sharedmem') as parallel:
+                parallel(delayed(one_bootstrap)(i,k) for i,k in
+                         enumerate(tqdm(range(i_min,i_max))))
+            arrays = {'stcs':stcs}
             if tfr:
                 for band in bands:
-                    fname3 = self._fname('sources','bootstrap_power_%s' %(band),
-                                         '.npz','%i-%i' %(i_min,i_max),event,
-                                         'ar'*(ar and not keyword_out),keyword_out)
-                    np.savez_compressed(fname3,powers=powers[band])
+                    arrays['powers_' + band] = powers[band]
                     if itc:
-                        fname4 = self._fname('sources','bootstrap_itc_%s' %(band),
-                                             '.npz','%i-%i' %(i_min,i_max),event,
-                                             'ar'*(ar and not keyword_out),keyword_out)
-                        np.savez_compressed(fname4,itcs=itcs[band])
-        inv = self._generate_inverse(epochs,fwd,bl_epochs,lambda2,method,
-                                     pick_ori)
+                        arrays['itcs_' + band] = itcs[band]
+            self._save_bootstrap_batch(arrays,i_min,i_max,event,ar,
+                                       keyword_out)
+        if not shared_baseline:
+            inv = self._generate_inverse(epochs,fwd,bl_epochs,lambda2,method,
+                                         pick_ori,rank=rank)
         evoked = epochs.average()
         stc = apply_inverse(evoked,inv,lambda2=lambda2,method=method,
                             pick_ori=pick_ori)
         np.savez_compressed(fname,events=events,batch=batch,tfr=tfr,itc=itc,
                             freqs=freqs,n_cycles=n_cycles,bands=bands,
                             bootstrap_indices=bootstrap_indices)
+        self._dir_cache.pop('sources',None)
         self._save_source(stc,event,'Bootstrap','base',ar=ar,keyword=keyword_out)
 
+    def _bootstrap_batch_fnames(self,i_min,i_max,event,ar,keyword,name):
+        # the h5 file has all the arrays of the batch, the npz files (when
+        # h5py isn't installed) one each: 'stcs', 'powers_<band>' and
+        # 'itcs_<band>'
+        tags = ('%i-%i' %(i_min,i_max),event,'ar'*(ar and not keyword),
+                keyword)
+        kind,_,band = name.partition('_')
+        tag = ('bootstrap' if kind == 'stcs' else
+               'bootstrap_%s_%s' %(kind[:-1],band))
+        return (self._fname('sources','bootstrap','.h5',*tags),
+                self._fname('sources',tag,'.npz',*tags),kind)
+
+    def _bootstrap_batch_exists(self,i_min,i_max,event,ar,keyword):
+        fname,fname2,_ = self._bootstrap_batch_fnames(i_min,i_max,event,ar,
+                                                      keyword,'stcs')
+        return (self._isfile('sources',fname2) or
+                (h5py is not None and self._isfile('sources',fname)))
+
+    def _save_bootstrap_batch(self,arrays,i_min,i_max,event,ar,keyword):
+        self._dir_cache.pop('sources',None)
+        if h5py is None:
+            for name,arr in arrays.items():
+                _,fname2,kind = self._bootstrap_batch_fnames(
+                    i_min,i_max,event,ar,keyword,name)
+                self._savez(fname2,**{kind:arr})
+            return
+        # chunked by bootstrap so the batch is written and read in whole
+        # bootstrap blocks from one file
+        fname,_,_ = self._bootstrap_batch_fnames(i_min,i_max,event,ar,
+                                                 keyword,'stcs')
+        with h5py.File(fname,'w') as f:
+            for name,arr in arrays.items():
+                f.create_dataset(name,data=arr,chunks=(1,) + arr.shape[1:])
+
+    def _load_bootstrap_batch(self,name,i_min,i_max,event,ar,keyword):
+        fname,fname2,kind = self._bootstrap_batch_fnames(i_min,i_max,event,
+                                                         ar,keyword,name)
+        if h5py is not None and self._isfile('sources',fname):
+            with h5py.File(fname,'r') as f:
+                return f[name][:]
+        return np.load(fname2)[kind]
+
     def sourceCorrelation(self,event,condition,ar=False,keyword_in=None,
                           keyword_out=None,baseline=(-0.5,-0.1),
                           n_permutations=1000,overwrite=False):
@@ -2481,140 +2927,86 @@ class MEEGbuddy:
                                'ar'*(ar and not keyword_out),keyword_in)
         fname_out = self._fname('sources','correlation','.npz',event,
                                 'ar'*(ar and not keyword_out),keyword_in)
-        if not os.path.isfile(fname_in):
+        if not self._isfile('sources',fname_in):
             raise ValueError('Bootstraps must be computed first' +
                              '(check that keywords match)')
-        if os.path.isfile(fname_out) and not overwrite:
+        if self._isfile('sources',fname_out) and not overwrite:
             raise ValueError('Correlations already exist, use overwrite=True')
         f = np.load(fname_in)
         bootstrap_indices = f['bootstrap_indices']
         Nboot,Nave = bootstrap_indices.shape
         batch = f['batch'].item()
+        Nboot -= Nboot % batch # only whole batches of bootstraps are computed
         bands = f['bands'].item()
         tfr = f['tfr'].item()
         itc = f['itc'].item()
         events = f['events']
-        bootstrap_conditions = []
-        for i in range(Nboot):
-            bootstrap_conditions.append(
-                np.nanmean(np.array([self.behavior[condition][j]
-                                    for j in bootstrap_indices[i]])))
+        bootstrap_conditions = np.nanmean(
+            np.asarray(self._behavior_array(condition),
+                       dtype=np.float64)[bootstrap_indices[:Nboot]],axis=1)
         stc = self._load_source(event,'Bootstrap','base',ar=ar,keyword=keyword_in)
         if baseline[0] < stc.tmin or baseline[1] > stc.times[-1]:
             raise ValueError('Baseline outside time range')
-        nSRC,nTIMES = stc.shape
         bl_indices = np.where((stc.times >= baseline[0]) &
                               (stc.times < baseline[1]))[0]
         permutation_indices = np.random.randint(0,Nboot,(n_permutations,Nboot))
         stc_copy = stc.copy()
         stc_copy.data.fill(0)
-        #
-        stcs = np.memmap('sb_%s_%s_%s_workfile' %(event,ar,keyword_out),
-                         dtype='float64', mode='w+',
-                         shape=(Nboot,nSRC,nTIMES))
         stc_result = stc_copy.copy()
-        bl_dist = np.zeros((stc.data.shape[0],n_permutations))
         if tfr:
-            powers = {band:np.memmap(('sb_power_%s_%s_%s_%s_workfile'
-                                      %(event,ar,keyword_out,band)),
-                                     dtype='float64', mode='w+',
-                                     shape=(Nboot,nSRC,nTIMES))
-                      for band in bands}
             power_result = {band:stc_copy.copy() for band in bands}
-            power_bl_dist = {band:np.zeros((stc.data.shape[0],n_permutations))
-                             for band in bands}
             if itc:
-                itcs = {band:np.memmap(('sb_itc_%s_%s_%s_%s_workfile'
-                                        %(event,ar,keyword_out,band)),
-                                        dtype='float64', mode='w+',
-                                        shape=(Nboot,nSRC,nTIMES))
-                        for band in bands}
                 itc_result = {band:stc_copy.copy() for band in bands}
-                itc_bl_dist = {band:np.zeros((stc.data.shape[0],n_permutations))
-                               for band in bands}
+        # the batches are streamed once into running sums and the baseline
+        # means instead of being combined into bootstraps x sources x times
+        # work files, the centered conditions make the sums enough for the
+        # correlations
+        y = bootstrap_conditions - bootstrap_conditions.mean()
+        sums = {}
         mins = range(0,Nboot-batch +1,batch)
         maxs = range(batch,Nboot+1,batch)
         for i_min,i_max in zip(mins,maxs):
             print('Combining bootstraps %i to %i source' %(i_min,i_max),end='')
-            fname2 = self._fname('sources','bootstrap','.npz',
-                                 '%i-%i' %(i_min,i_max),event,
-                                 'ar'*(ar and not keyword_out),keyword_out)
-            stcs2 = np.load(fname2)['stcs']
-            for i,j in enumerate(range(i_min,i_max)):
-                stcs[j] = stcs2[i]
-            del stcs2
+            sums['stc'] = _correlation_sums(
+                sums.get('stc'),
+                self._load_bootstrap_batch('stcs',i_min,i_max,event,ar,
+                                           keyword_out),
+                y[i_min:i_max],bl_indices)
             if tfr:
                 for band in bands:
                     print(' %s tfr' %(band), end='')
-                    fname3 = self._fname('sources','bootstrap_power_%s' %(band),
-                                         '.npz','%i-%i' %(i_min,i_max),event,
-                                         'ar'*(ar and not keyword_out),keyword_out)
-                    powers2 = np.load(fname3)['powers']
+                    key = 'power_' + band
+                    sums[key] = _correlation_sums(
+                        sums.get(key),
+                        self._load_bootstrap_batch('powers_' + band,i_min,
+                                                   i_max,event,ar,keyword_out),
+                        y[i_min:i_max],bl_indices)
                     if itc:
                         print(' %s itc' %(band), end='')
-                        fname4 = self._fname('sources','bootstrap_itc_%s' %(band),
-                                             '.npz','%i-%i' %(i_min,i_max),event,
-                                             'ar'*(ar and not keyword_out),keyword_out)
-                        itcs2 = np.load(fname4)['itcs']
-                    for i,j in enumerate(range(i_min,i_max)):
-                        powers[band][j] = powers2[i]
-                        if itc:
-                            itcs[band][j] = itcs2[i]
-                    del powers2
-                    if itc:
-                        del itcs2
+                        key = 'itc_' + band
+                        sums[key] = _correlation_sums(
+                            sums.get(key),
+                            self._load_bootstrap_batch('itcs_' + band,i_min,
+                                                       i_max,event,ar,
+                                                       keyword_out),
+                            y[i_min:i_max],bl_indices)
             print(' Done.')
-        # Get baseline distribution
-        for s_ind in tqdm(range(nSRC)):
-            s_data = stcs[:,s_ind]
-            if tfr:
-                power_s_data = {band:powers[band][:,s_ind] for band in bands}
-                if itc:
-                    itc_s_data = {band:itcs[band][:,s_ind] for band in bands}
-            for p_ind in range(n_permutations):
-                dist = s_data[:,bl_indices].mean(axis=1)
-                _,_,r,_,_ = linregress(dist[permutation_indices[p_ind]],
-                                       bootstrap_conditions)
-                bl_dist[s_ind,p_ind] = r
-                if tfr:
-                    for band in bands:
-                        power_dist = power_s_data[band][:,bl_indices].mean(axis=1)
-                        _,_,r,_,_ = linregress(power_dist[permutation_indices[p_ind]],
-                                               bootstrap_conditions)
-                        power_bl_dist[band][s_ind,p_ind] = r
-                        if itc:
-                            itc_dist = itc_s_data[band][:,bl_indices].mean(axis=1)
-                            _,_,r,_,_ = linregress(itc_dist[permutation_indices[p_ind]],
-                                                   bootstrap_conditions)
-                            itc_bl_dist[band][s_ind,p_ind] = r
-        # Get p-values from permutation distribution
-        for s_ind in tqdm(range(nSRC)):
-            s_data = stcs[:,s_ind]
-            if tfr:
-                power_s_data = {band:powers[band][:,s_ind] for band in bands}
+        # the permutation and time point correlations are matrix products
+        # over all the bootstraps instead of a linregress per source, time
+        # and permutation
+        print('Correlating source')
+        counts,weights = _permutation_weights(y,permutation_indices)
+        stc_result.data[:] = _permutation_correlation(sums.pop('stc'),y,
+                                                      counts,weights)
+        if tfr:
+            for band in bands:
+                print('Correlating %s power' %(band))
+                power_result[band].data[:] = _permutation_correlation(
+                    sums.pop('power_' + band),y,counts,weights)
                 if itc:
-                    itc_s_data = {band:itcs[band][:,s_ind] for band in bands}
-            for t_ind in range(nTIMES):
-                dist = s_data[:,t_ind]
-                _,_,r,_,_ = linregress(dist,bootstrap_conditions)
-                p = sum(abs(bl_dist[s_ind])>abs(r))/n_permutations
-                stc_result.data[s_ind,t_ind] = ((1.0/p)*np.sign(r) if p > 0 else
-                                                (1.0/n_permutations)*np.sign(r))
-                if tfr:
-                    for band in bands:
-                        power_dist = power_s_data[band][:,t_ind]
-                        _,_,r,_,_ = linregress(power_dist,bootstrap_conditions)
-                        p = sum(abs(power_bl_dist[band][s_ind])>abs(r))/n_permutations
-                        power_result[band].data[s_ind,t_ind] = \
-                            ((1.0/p)*np.sign(r) if p > 0 else
-                             (1.0/n_permutations)*np.sign(r))
-                        if itc:
-                            itc_dist = itc_s_data[band][:,t_ind]
-                            _,_,r,_,_ = linregress(itc_dist,bootstrap_conditions)
-                            p = sum(abs(itc_bl_dist[band][s_ind])>abs(r))/n_permutations
-                            itc_result[band].data[s_ind,t_ind] = \
-                                ((1.0/p)*np.sign(r) if p > 0 else
-                                 (1.0/n_permutations)*np.sign(r))
+                    print('Correlating %s itc' %(band))
+                    itc_result[band].data[:] = _permutation_correlation(
+                        sums.pop('itc_' + band),y,counts,weights)
         self._save_source(stc_result,event,condition,'correlation',
                           ar=ar,keyword=keyword_out)
         if tfr:
@@ -2661,42 +3053,50 @@ class MEEGbuddy:
             Y = epochs[indices].get_data()
             inv,lambda2,method,pick_ori = \
                 self._load_inverse(event,condition,value,ar=ar,keyword=keyword)
-            nSRC = inv['nsource']
-            nTIME = len(epochs.times)
             J = apply_inverse(epochs[indices].average(),inv,
                    method=method,lambda2=lambda2,
                    pick_ori=pick_ori,verbose=False).data
-            basecorr = np.mean(J[:,bl_tind],axis=1)
-            N0 = len(bl_tind)
+            # sources as column vectors broadcast over the times
+            basecorr = np.mean(J[:,bl_tind],axis=1)[:,np.newaxis]
             Norm = np.std(J[:,bl_tind],axis=1,ddof=1)
-            J-=np.kron(np.ones((1,nTIME)),basecorr.reshape((nSRC,1)))
-            NUM = np.kron(np.ones((1,N0)),basecorr.reshape((nSRC,1)))
-            DEN = np.kron(np.ones((1,N0)),Norm.reshape((nSRC,1)))
+            J-=basecorr
+            NUM = basecorr
+            DEN = Norm[:,np.newaxis]
             return Y,J,inv,lambda2,method,pick_ori,NUM,DEN,Norm
 
         def downsampleIndices(indices,nTR,condition,value):
             print('Subsampling %i/%i ' %(nTR,len(indices)) +
                   'for %s %s.' %(condition,value))
-            np.random.shuffle(indices)
-            indices = indices[:nTR]
-            indices = sorted(indices)
+            indices = np.sort(np.random.choice(indices,nTR,replace=False))
             return indices
 
         def baseline_bootstrap(Y,J,bl_tind,Norm,NUM,DEN,Nboot,alpha,
                                info,inv,lambda2,method,pick_ori):
             nTR,nCH,nTIME = Y.shape
-            nSRC = J.shape[0]
             N0 = len(bl_tind)
             randontrialsT=np.random.randint(0,nTR,nTR)
+            YR=Y[randontrialsT]
+            # the samples of all the trials are drawn at once and gathered
+            # in one indexing, broadcast over the channels
+            trial_ind=np.arange(nTR)[:,np.newaxis,np.newaxis]
+            ch_ind=np.arange(nCH)[np.newaxis,:,np.newaxis]
+            # the inverse is the same for every bootstrap, with normal
+            # orientations it's a fixed matrix (which includes the
+            # projections) applied to the trial average
+            kernel = (self._inverse_kernel(inv,info,nTR,lambda2,method,
+                                           pick_ori)
+                      if pick_ori == 'normal' else None)
             Bootstraps=np.zeros((Nboot,N0))
             for per in tqdm(range(Nboot)):
-                YT=np.zeros((nTR,nCH,N0))
-                for j in range(nTR):
-                    randonsampT = np.random.choice(bl_tind,N0,replace=True)#np.random.randint(0,N0,N0)
-                    YT[j] = Y[randontrialsT[j]][:,randonsampT]
-                YTE = EpochsArray(YT,info,verbose=False)
-                ET=apply_inverse(YTE.average(),inv,method=method,
-                                 lambda2=lambda2,pick_ori=pick_ori,verbose=False).data
+                randonsampT = np.random.choice(bl_tind,(nTR,N0),replace=True)
+                YT = YR[trial_ind,ch_ind,randonsampT[:,np.newaxis,:]]
+                if kernel is not None:
+                    ET=kernel.dot(YT.mean(axis=0))
+                else:
+                    YTE = EpochsArray(YT,info,verbose=False)
+                    ET=apply_inverse(YTE.average(),inv,method=method,
+                                     lambda2=lambda2,pick_ori=pick_ori,
+                                     verbose=False).data
                 ET=(ET-NUM)/DEN # computes a Z-value
                 Bootstraps[per,:] = np.max(np.abs(ET),axis=0) # maximum statistics in space
             # computes threshold for binarization depending on alpha value
@@ -2704,14 +3104,10 @@ class MEEGbuddy:
             calpha=1-alpha
             calpha_index=int(np.floor(calpha*Nboot*N0))
             TT=Norm*Bootstraps[calpha_index]# computes threshold based on alpha set before
-            Threshold=np.kron(np.ones((1,nTIME)),TT.reshape((nSRC,1)))
-            return Threshold
+            return TT[:,np.newaxis] # broadcasts over the times of J
 
         def threshold_50_50(J,tind):
-            Threshold = np.zeros((J.shape))
-            for i in range(J.shape[0]):
-                Threshold[i,:] = np.median(abs(J[i,tind]))
-            return Threshold
+            return np.median(abs(J[:,tind]),axis=1)[:,np.newaxis]
 
         def gettind(epochs,tmin,tmax,npoint_art,value):
              # setup for if a dynamic tmin/max is to be used
@@ -2772,12 +3168,10 @@ class MEEGbuddy:
                 tind = gettind(epochs,tmin,tmax,npoint_art,value)
                 #J = J[:,tind]
                 # determines sources matrices
-                binJ=np.array(np.abs(J)>Threshold,dtype=int)
+                binJ,row_sums=_binarize(J,Threshold)
                 # rank the activity matrix - use mergesort that yields same results of Matlab
-                Irank=np.argsort(np.sum(binJ,axis=1),kind='mergesort')
-                binJrank=np.copy(binJ)
-                binJrank=binJ[Irank,:]
-                binJ=binJrank[:,tind]
+                Irank=np.argsort(row_sums,kind='mergesort')
+                binJ=binJ[np.ix_(Irank,tind)] # rank and crop in one gather
                 ct = computePCI(binJ)
                 self._save_noreun_PCI(ct,binJ,tmin,tmax,npoint_art,
                                       event,condition,value,ar,keyword_out)
@@ -2877,9 +3271,9 @@ class MEEGbuddy:
             ax.set_xticklabels(np.round(np.linspace(start,tmax,5),2))
 
         if pci: [ax.set_ylim(ymax=yMAX*1.05) for ax in axs]
-        title = ('%s %s' %(event,condition) + ' Significant Sources'*ssm +
-                 ' and'*(pci and ssm) + ' PCI'*pci + ' ar'*ar +
-                 ' %s' %(keyword) * (keyword is not None))
+        title = ('%s %s' %(event,condition) + _tag(' Significant Sources',ssm) +
+                 _tag(' and',pci and ssm) + _tag(' PCI',pci) + _tag(' ar',ar) +
+                 (' %s' %(keyword) if keyword is not None else ''))
         fig.suptitle(title,fontsize=fontsize)
         fig.savefig(self._fname('plots','noreun_phi_plot','.jpg','ar'*ar,
                                 keyword,event,condition,*values))
@@ -2973,6 +3367,475 @@ class MEEGbuddy:
         view = (-88.7, 40.8, 0.76, np.array([-3.9e-4, -8.5e-3, -1e-2]))
         mlab.view(*view)
 
+def _fit_ica(inst,dt,n_components,seed,method='fastica',decim=None,
+             reject=None,start=None,stop=None):
+    fit_params = dict(ortho=True,extended=True) if method == 'picard' else None
+    ica = ICA(method=method,fit_params=fit_params,n_components=n_components,
+              random_state=seed)
+    # fit on picks rather than a copy of the whole inst for each data type
+    picks = pick_types(inst.info,meg=False if dt == 'eeg' else dt,
+                       eeg=(dt == 'eeg'))
+    ica.fit(inst,picks=picks,decim=decim,reject=reject,start=start,stop=stop)
+    return ica
+
+def _ica_mixing(ica):
+    ''' Returns the sensor space mixing and unmixing matrices of a fitted ICA
+        (including pre-whitening) and the source offset from the PCA mean,
+        so that removing components is
+        data - mixing[:,exclude].dot(unmixing[exclude].dot(data) - offset[exclude])
+        which is what ica.apply does without copying the instance.'''
+    pca_components = ica.pca_components_[:ica.n_components_]
+    unmixing = np.dot(ica.unmixing_matrix_,pca_components)
+    mixing = np.dot(pca_components.T,ica.mixing_matrix_)
+    if ica.pca_mean_ is None:
+        offset = np.zeros(ica.n_components_)
+    else:
+        offset = np.dot(unmixing,ica.pca_mean_)
+    if ica.noise_cov is None:
+        unmixing = unmixing/ica.pre_whitener_.T
+        mixing = mixing*ica.pre_whitener_
+    else:
+        unmixing = np.dot(unmixing,ica.pre_whitener_)
+        mixing = np.dot(linalg.pinv(ica.pre_whitener_,cond=1e-14),mixing)
+    return mixing,unmixing,offset
+
+def _apply_ica_fast(ica,inst,exclude=None,copy=True,use_gpu=False):
+    ''' Same as ica.apply for preloaded raw or epochs but the component
+        removal is done as a single projection matrix on the ica channels,
+        on the GPU if use_gpu and cupy is installed.'''
+    exclude = sorted(ica.exclude if exclude is None else exclude)
+    if copy:
+        inst = inst.copy()
+    if not exclude:
+        return inst
+    mixing,unmixing,offset = _ica_mixing(ica)
+    picks = [inst.ch_names.index(name) for name in ica.ch_names]
+    proj = np.eye(len(picks)) - mixing[:,exclude].dot(unmixing[exclude])
+    shift = mixing[:,exclude].dot(offset[exclude])
+    xp = _get_xp(use_gpu)
+    proj,shift = xp.asarray(proj),xp.asarray(shift)
+    if inst._data.ndim == 2:
+        data = proj.dot(xp.asarray(inst._data[picks])) + shift[:,np.newaxis]
+        inst._data[picks] = _to_numpy(data)
+    else:
+        data = (xp.einsum('ij,ejt->eit',proj,xp.asarray(inst._data[:,picks])) +
+                shift[np.newaxis,:,np.newaxis])
+        inst._data[:,picks] = _to_numpy(data)
+    return inst
+
+def _count_flat_reject(data,picks,starts,datalen,flat_thresh,reject_thresh):
+    ''' Counts for each pick how many of the windows
+        data[picks[i],s:s+datalen] for s in starts are flat or over the
+        reject threshold peak to peak, in one pass without copying the
+        windows.'''
+    n_ch,n_seeds = len(picks),len(starts)
+    flat_counts = np.zeros(n_ch,dtype=np.int64)
+    reject_counts = np.zeros(n_ch,dtype=np.int64)
+    for i in prange(n_ch):
+        ch = picks[i]
+        for j in range(n_seeds):
+            s = starts[j]
+            min_c = data[ch,s]
+            max_c = min_c
+            for k in range(s+1,s+datalen):
+                v = data[ch,k]
+                if v < min_c:
+                    min_c = v
+                elif v > max_c:
+                    max_c = v
+            diff_c = max_c - min_c
+            if diff_c < flat_thresh:
+                flat_counts[i] += 1
+            if diff_c > reject_thresh:
+                reject_counts[i] += 1
+    return flat_counts,reject_counts
+
+if njit is not None:
+    # compiled once and cached to disk so only the first call pays the jit
+    _count_flat_reject = njit(parallel=True,fastmath=True,
+                              cache=True)(_count_flat_reject)
+
+def _seed_counts(data,picks,starts,datalen,flat_thresh,reject_thresh,
+                 n_jobs=None):
+    if njit is not None:
+        # asarray views a memmap as a plain array without reading it
+        return _count_flat_reject(np.asarray(data),np.asarray(picks),starts,
+                                  datalen,flat_thresh,reject_thresh)
+    windows = starts[:,np.newaxis] + np.arange(datalen)
+    def count(i):
+        # gather all the seed windows at once (seeds x datalen)
+        seed = data[picks[i]][windows]
+        diff_c = seed.max(axis=1) - seed.min(axis=1)
+        return (diff_c < flat_thresh).sum(),(diff_c > reject_thresh).sum()
+    # numpy releases the GIL in the gather and reductions so threads work
+    # and share the data without copying it to other processes
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        counts = list(executor.map(count,range(len(picks))))
+    flat_counts = np.array([c[0] for c in counts],dtype=int)
+    reject_counts = np.array([c[1] for c in counts],dtype=int)
+    return flat_counts,reject_counts
+
+def _histogram2d(x,y,bins):
+    ''' Same as np.histogram2d(x,y,bins=bins) for an integer number of
+        bins over the data range, but the bins of both coordinates are
+        searched in the edges at once and counted with one bincount.'''
+    edges = []
+    inds = []
+    for v in (x,y):
+        vmin,vmax = (v.min(),v.max()) if len(v) else (0.,1.)
+        if vmin == vmax:
+            vmin,vmax = vmin - 0.5,vmax + 0.5
+        e = np.linspace(vmin,vmax,bins + 1)
+        # values on an edge go to the bin above it like in numpy, except
+        # for the last edge which is in the last bin
+        inds.append(np.minimum(np.searchsorted(e,v,side='right') - 1,
+                               bins - 1))
+        edges.append(e)
+    H = np.bincount(inds[0]*bins + inds[1],
+                    minlength=bins**2).reshape(bins,bins).astype(float)
+    return H,edges[0],edges[1]
+
+def _sorted_range(x,xmin,xmax):
+    ''' Start and stop indices of the elements of the sorted x that are
+        within [xmin,xmax].'''
+    return (np.searchsorted(x,xmin,side='left'),
+            np.searchsorted(x,xmax,side='right'))
+
+def _line_segments(x,ys):
+    ''' (n_lines x n_points x 2) segments of the lines ys (n_lines x n_points)
+        against the shared x for a LineCollection.'''
+    return np.stack([np.broadcast_to(x,ys.shape),ys],axis=-1)
+
+def _as_slice(indices):
+    ''' Returns a slice for sorted consecutive indices so that indexing
+        with it is a view instead of a copy, otherwise the indices.'''
+    if len(indices) and indices[-1] - indices[0] == len(indices) - 1 and \
+            np.all(np.diff(indices) == 1):
+        return slice(indices[0],indices[-1] + 1)
+    return indices
+
+def _welford(data,mean,std):
+    ''' Mean and (population) std over the first axis of data
+        (n x channels x times, any strides) into mean and std (channels x
+        times, zeroed) in a single pass, with Welford's updates on the
+        channels in parallel.'''
+    n,n_ch,n_times = data.shape
+    for c in prange(n_ch):
+        for e in range(n):
+            for t in range(n_times):
+                x = data[e,c,t]
+                d = x - mean[c,t]
+                mean[c,t] += d/(e + 1)
+                std[c,t] += d*(x - mean[c,t])
+        for t in range(n_times):
+            std[c,t] = np.sqrt(std[c,t]/n)
+    return mean,std
+
+if njit is not None:
+    _welford = njit(parallel=True,fastmath=True,cache=True)(_welford)
+
+def _mean_std(data,mean,std):
+    ''' Fills mean and std with data.mean(axis=0) and data.std(axis=0) for
+        n x channels x times data, in one pass over data (without copying
+        strided views) if numba is installed.'''
+    if njit is None:
+        data.mean(axis=0,out=mean)
+        data.std(axis=0,out=std)
+        return mean,std
+    mean[...] = 0
+    std[...] = 0
+    _welford(data,mean,std)
+    return mean,std
+
+def _binarize_rows(J,Threshold,binJ,row_sums):
+    ''' binJ = abs(J) > Threshold as uint8 and its row sums in one pass
+        over J, rows in parallel.'''
+    n,m = J.shape
+    for i in prange(n):
+        total = 0
+        for j in range(m):
+            if J[i,j] > Threshold[i,j] or J[i,j] < -Threshold[i,j]:
+                binJ[i,j] = 1
+                total += 1
+            else:
+                binJ[i,j] = 0
+        row_sums[i] = total
+    return binJ,row_sums
+
+if njit is not None:
+    _binarize_rows = njit(parallel=True,fastmath=True,
+                          cache=True)(_binarize_rows)
+
+def _binarize(J,Threshold):
+    ''' The sources x times uint8 matrix of abs(J) > Threshold (sources x
+        1 or sources x times) and its row sums.'''
+    if njit is None:
+        binJ = (np.abs(J) > Threshold).view(np.uint8)
+        return binJ,binJ.sum(axis=1)
+    binJ = np.empty(J.shape,dtype=np.uint8)
+    row_sums = np.empty(J.shape[0],dtype=np.int64)
+    return _binarize_rows(J,np.broadcast_to(Threshold,J.shape),binJ,row_sums)
+
+def _sliding_windows(data,win_len,hop):
+    ''' Read-only (n_windows x win_len) view of the windows of the 1D data
+        starting every hop samples, without copying.'''
+    n_windows = (len(data) - win_len)//hop + 1
+    return np.lib.stride_tricks.as_strided(
+        data,shape=(n_windows,win_len),
+        strides=(data.strides[0]*hop,data.strides[0]),writeable=False)
+
+def _multitaper_tapers(n,Fs,NW,BW,low_bias):
+    ''' The dpss tapers and eigenvalues that nitime's multi_taper_psd uses
+        for windows of n samples (BW takes precedence over NW as there).'''
+    if BW is not None:
+        NW = np.round(BW*n/Fs)/2.0
+    dpss,eigvals = dpss_windows(n,NW,int(2*NW))
+    if low_bias:
+        keepers = eigvals > 0.9
+        dpss,eigvals = dpss[keepers],eigvals[keepers]
+    return dpss,eigvals
+
+def _multitaper_batch(windows,out,dpss,eigvals,Fs,adaptive=False):
+    ''' Writes the onesided psd of nitime's multi_taper_psd for each of the
+        windows to its row of out (windows x frequencies), with the
+        precomputed tapers and all the windows tapered in one FFT.'''
+    spectra = tapered_spectra(np.asarray(windows),dpss) # windows x K x NFFT
+    if adaptive:
+        weights = np.stack([adaptive_weights(sp,eigvals,sides='onesided')[0]
+                            for sp in spectra],axis=1)
+    else:
+        weights = np.sqrt(eigvals)[:,np.newaxis,np.newaxis]
+    spectra = np.rollaxis(spectra,1)
+    out[:] = mtm_cross_spectrum(spectra,spectra,weights,sides='onesided')/Fs
+    return out
+
+def _accumulate_psd(log_psd,step,image):
+    ''' Fills each column c of image (frequencies x columns) with the mean
+        of the windows i that cover it (i <= c < i+step), one column per
+        thread so that no two threads write the same element.'''
+    n_windows,n_freqs = log_psd.shape
+    for c in prange(image.shape[1]):
+        first = max(0,c-step+1)
+        last = min(n_windows,c+1)
+        for k in range(n_freqs):
+            acc = 0.0
+            for i in range(first,last):
+                acc += log_psd[i,k]
+            image[k,c] = acc/(last-first)
+    return image
+
+if njit is not None:
+    _accumulate_psd = njit(parallel=True,fastmath=True,
+                           cache=True)(_accumulate_psd)
+
+def _spectrogram_image(log_psd,step,n_cols):
+    ''' Averages the overlapping window log psds (windows x frequencies)
+        into a frequencies x n_cols image where window i covers the
+        columns i to i+step.'''
+    image = np.zeros((log_psd.shape[1],n_cols))
+    if njit is not None:
+        return _accumulate_psd(log_psd,step,image)
+    n_windows = log_psd.shape[0]
+    counters = np.zeros(n_cols)
+    # add the whole log-spectrogram once per window offset
+    for j in range(step):
+        image[:,j:j+n_windows] += log_psd.T
+        counters[j:j+n_windows] += 1
+    image /= counters
+    return image
+
+def _correlation_sums(sums,x,y,bl_indices):
+    ''' Adds a batch of bootstraps x sources x times x with their centered
+        conditions y to the running sums (None to start) that
+        _permutation_correlation needs, in float64 and shifted by the
+        first bootstrap so the sums of squares don't cancel.'''
+    x = np.array(x,dtype=np.float64)
+    if sums is None:
+        sums = {'shift':x[0].copy(),'x':0,'xx':0,'xy':0,'bl':[]}
+    x -= sums['shift']
+    sums['x'] = sums['x'] + x.sum(axis=0)
+    sums['xx'] = sums['xx'] + np.einsum('ijk,ijk->jk',x,x)
+    sums['xy'] = sums['xy'] + np.tensordot(y,x,axes=1)
+    sums['bl'].append(x[:,:,bl_indices].mean(axis=2))
+    return sums
+
+def _correlation(xy,ss,y_norm):
+    ''' Pearson r from the products with the centered y, the centered sums
+        of squares and the norm of y, 0 where either is constant like
+        linregress.'''
+    den = np.sqrt(np.maximum(ss,0))*y_norm
+    return np.where(den > 0,xy/np.where(den > 0,den,1),0)
+
+def _permutation_weights(y,permutation_indices):
+    ''' How many times each bootstrap is drawn in each permutation and the
+        centered conditions y summed the same way (n_permutations x Nboot
+        each), which are the same for every array that is correlated.'''
+    n_permutations,n = permutation_indices.shape
+    # one bincount with each permutation offset to its own row
+    flat = (permutation_indices +
+            n*np.arange(n_permutations)[:,np.newaxis]).ravel()
+    counts = np.bincount(flat,minlength=n_permutations*n)
+    weights = np.bincount(flat,weights=np.tile(y,n_permutations),
+                          minlength=n_permutations*n)
+    return (counts.reshape(n_permutations,n).astype(np.float64),
+            weights.reshape(n_permutations,n))
+
+def _permutation_correlation(sums,y,counts,weights):
+    ''' From the _correlation_sums of Nboot bootstraps, the correlation
+        of each source and time with the centered conditions y as 1/p
+        signed by the correlation (1/n_permutations if p is 0), where p is
+        the fraction of permutations of the baseline mean that correlate
+        more strongly, like linregress on each but with the permutations
+        as products with the _permutation_weights.'''
+    n_permutations,n = counts.shape
+    y_norm = np.sqrt(y.dot(y))
+    r = _correlation(sums['xy'],sums['xx'] - sums['x']**2/n,y_norm)
+    bl = np.concatenate(sums['bl'])
+    bl -= bl.mean(axis=0)
+    bl_mean = counts.dot(bl)/n
+    bl_ss = counts.dot(bl**2) - n*bl_mean**2
+    bl_r = np.abs(_correlation(weights.dot(bl),bl_ss,y_norm)).T
+    bl_r.sort(axis=1)
+    p = _count_greater(bl_r,np.abs(r))/float(n_permutations)
+    return np.where(p > 0,np.sign(r)/np.where(p > 0,p,1),
+                    np.sign(r)/n_permutations)
+
+def _count_greater_rows(sorted_rows,values,out):
+    ''' For each row, how many of the sorted_rows (rows x n, sorted
+        along each row) are greater than each of the values (rows x m),
+        by binary search, rows in parallel.'''
+    n = sorted_rows.shape[1]
+    for i in prange(values.shape[0]):
+        for j in range(values.shape[1]):
+            v = values[i,j]
+            lo = 0
+            hi = n
+            while lo < hi:
+                mid = (lo + hi)//2
+                if v < sorted_rows[i,mid]:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            out[i,j] = n - lo
+    return out
+
+if njit is not None:
+    # no fastmath, the comparisons have to stay exact
+    _count_greater_rows = njit(parallel=True,cache=True)(_count_greater_rows)
+
+def _count_greater(sorted_rows,values):
+    out = np.empty(values.shape,dtype=np.int64)
+    if njit is None:
+        n = sorted_rows.shape[1]
+        for i in range(values.shape[0]):
+            out[i] = n - np.searchsorted(sorted_rows[i],values[i],
+                                         side='right')
+        return out
+    return _count_greater_rows(np.ascontiguousarray(sorted_rows),values,out)
+
+@lru_cache(maxsize=32)
+def _filter_coefs(sfreq,l_freq,h_freq):
+    return create_filter(None,sfreq,l_freq,h_freq,fir_design='firwin',
+                         verbose=False)
+
+def _filter_inst(inst,l_freq,h_freq,n_jobs=1,pad='edge'):
+    ''' Filters preloaded epochs or evoked in place like
+        inst.filter(l_freq=l_freq,h_freq=h_freq,n_jobs=n_jobs) with its
+        default zero phase FIR and edge padding, but the filter is only
+        designed once per sfreq and band. Raw is filtered by mne so it
+        isn't filtered across the boundaries of appended files.'''
+    if l_freq is None and h_freq is None:
+        return inst
+    if isinstance(inst,BaseRaw):
+        return inst.filter(l_freq=l_freq,h_freq=h_freq,n_jobs=n_jobs)
+    info = inst.info
+    h = _filter_coefs(float(info['sfreq']),l_freq,h_freq)
+    picks = pick_types(info,meg=True,eeg=True,seeg=True,ecog=True,exclude=[])
+    _overlap_add_filter(inst._data,h,phase='zero',picks=picks,n_jobs=n_jobs,
+                        copy=False,pad=pad)
+    if h_freq is not None and (info['lowpass'] is None or
+                               h_freq < info['lowpass']):
+        info['lowpass'] = float(h_freq)
+    if l_freq is not None and (info['highpass'] is None or
+                               l_freq > info['highpass']):
+        info['highpass'] = float(l_freq)
+    return inst
+
+def _tag(s,cond):
+    ''' Returns s if cond else an empty string, for optional parts of
+        messages instead of multiplying strings by booleans.'''
+    return s if cond else ''
+
+def _get_xp(use_gpu):
+    if use_gpu and cp is None:
+        print('Unable to import cupy, using numpy')
+    return cp if use_gpu and cp is not None else np
+
+def _to_numpy(arr):
+    return arr if isinstance(arr,np.ndarray) else cp.asnumpy(arr)
+
+def _wavelet_ffts(wavelets,n_times,xp,dtype=np.complex128):
+    ''' The FFTs of the wavelets padded to a common fast length for
+        convolving n_times long signals, and where each same mode
+        convolution starts (each wavelet is centered on its own length).'''
+    nfft = next_fast_len(n_times + max([len(w) for w in wavelets]) - 1)
+    ws = np.zeros((len(wavelets),nfft),dtype=np.complex128)
+    for i,w in enumerate(wavelets):
+        ws[i,:len(w)] = w
+    starts = [(len(w) - 1)//2 for w in wavelets]
+    return xp.fft.fft(xp.asarray(ws),axis=-1).astype(dtype),nfft,starts
+
+def _real_fft(x,nfft,xp):
+    ''' xp.fft.fft(x,n=nfft,axis=-1) for real x from the half length rfft,
+        the negative frequencies are the conjugates of the positive ones
+        (the wavelets are complex so the full spectrum is still needed).'''
+    half = xp.fft.rfft(x,n=nfft,axis=-1)
+    return xp.concatenate((half,xp.conj(half[...,1:nfft - nfft//2][...,::-1])),
+                          axis=-1)
+
+def _cwt_fast(data,wavelets,use_gpu=False,chunk=1024,wavelet_ffts=None,
+              dtype=np.complex128):
+    ''' Same as mne.time_frequency.tfr.cwt(data,wavelets,use_fft=True,
+        mode='same') for real signals x times data, but chunks of signals
+        are convolved with all the wavelets in batched FFTs, with cupy if
+        use_gpu. wavelet_ffts from _wavelet_ffts for these wavelets and
+        number of times skips transforming the wavelets on every call.
+        dtype=np.complex64 halves the output (and is single precision
+        throughout on the GPU).'''
+    xp = _get_xp(use_gpu)
+    n_times = data.shape[-1]
+    ws,nfft,starts = (_wavelet_ffts(wavelets,n_times,xp,dtype=dtype)
+                      if wavelet_ffts is None else wavelet_ffts)
+    real_dtype = np.float32 if dtype == np.complex64 else np.float64
+    out = np.empty((data.shape[0],len(wavelets),n_times),dtype=dtype)
+    for c in range(0,data.shape[0],chunk):
+        d = _real_fft(xp.asarray(data[c:c+chunk],dtype=real_dtype),nfft,xp)
+        conv = xp.fft.ifft(d[:,np.newaxis] * ws[np.newaxis],axis=-1)
+        for j,start in enumerate(starts):
+            out[c:c+chunk,j] = _to_numpy(conv[:,j,start:start+n_times])
+    return out
+
+def _compute_tfr_fast(data,freqs,n_cycles,sfreq,use_gpu=False,tind=None):
+    ''' Same as tfr_array_morlet(...,output='power') for epochs data
+        (n_epochs x n_channels x n_times) but each epoch is transformed with
+        one FFT that is shared by all the wavelets, with cupy if use_gpu.
+        If tind is given only those (consecutive) time indices are kept,
+        so the buffer is never stored.'''
+    xp = _get_xp(use_gpu)
+    n_times = data.shape[-1]
+    wavelets = morlet(sfreq,freqs,n_cycles=n_cycles)
+    ws,nfft,starts = _wavelet_ffts(wavelets,n_times,xp)
+    t0,t1 = (0,n_times) if tind is None else (tind[0],tind[-1] + 1)
+    power = np.empty(data.shape[:2] + (len(freqs),t1-t0))
+    for i,epoch in enumerate(data):
+        d = _real_fft(xp.asarray(epoch),nfft,xp)
+        conv = xp.fft.ifft(d[:,np.newaxis] * ws[np.newaxis],axis=-1)
+        for j,start in enumerate(starts):
+            this_conv = conv[:,j,start+t0:start+t1]
+            power[i,:,j] = _to_numpy(xp.square(this_conv.real) +
+                                     xp.square(this_conv.imag))
+    return power
+
 def _noreun_random_source(inv,lambda2,method,Y,
                           info,nSRC,N0,nTR,randontrialsT):
     randonsampT = np.random.randint(0,N0,N0)
@@ -0,0 +1,37 @@
+import os.path as op
+
+import numpy as np
+import pytest
+
+import mne
+from mne.minimum_norm import apply_inverse, read_inverse_operator
+
+from MEEGbuddy import MEEGbuddy
+
+data_path = mne.datasets.testing.data_path(download=False)
+s_path = op.join(data_path, 'MEG', 'sample')
+fname_raw = op.join(s_path, 'sample_audvis_trunc_raw.fif')
+fname_inv = op.join(s_path, 'sample_audvis_trunc-meg-eeg-oct-6-meg-inv.fif')
+requires_testing_data = pytest.mark.skipif(
+    not op.isfile(fname_inv), reason='Requires the mne testing dataset')
+
+
+@requires_testing_data
+def test_inverse_kernel_matches_apply_inverse():
+    """The shared baseline kernel applies to averages of epochs with
+    non-data (stim, EOG) channels like apply_inverse does."""
+    raw = mne.io.read_raw_fif(fname_raw, preload=True)
+    events = mne.find_events(raw, stim_channel='STI 014')
+    epochs = mne.Epochs(raw, events, event_id=1, tmin=-0.1, tmax=0.2,
+                        picks=None, baseline=None, preload=True)
+    assert len(epochs.ch_names) > len(epochs[:1].average().ch_names)
+    inv = read_inverse_operator(fname_inv)
+    lambda2 = 1. / 9.
+    nave = 5
+    kernel = MEEGbuddy._inverse_kernel(None, inv, epochs[:1].average().info,
+                                       nave, lambda2, 'dSPM', 'normal')
+    evoked = epochs[:nave].average()
+    stc = apply_inverse(evoked, inv, lambda2=lambda2, method='dSPM',
+                        pick_ori='normal')
+    np.testing.assert_allclose(kernel.dot(evoked.data), stc.data,
+                               rtol=1e-5, atol=1e-8 * np.abs(stc.data).max())